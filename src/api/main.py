@@ -3,23 +3,35 @@
 
 from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
+from starlette.formparsers import MultiPartParser
 from typing import List, Optional
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import asyncio
+import json
+import re
+import time
+from functools import lru_cache
+from itertools import islice
+
+import aiohttp
+import httpx
+import orjson
 
 # Azure SDK imports
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
-from azure.cosmos import CosmosClient
-from azure.keyvault.secrets import SecretClient
-from azure.ai.vision.imageanalysis import ImageAnalysisClient
+from azure.identity.aio import DefaultAzureCredential, ManagedIdentityCredential, get_bearer_token_provider
+from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient
+from azure.cosmos.aio import CosmosClient
+from azure.ai.vision.imageanalysis.aio import ImageAnalysisClient
 from azure.ai.vision.imageanalysis.models import VisualFeatures
-from azure.core.credentials import AzureKeyCredential
-from openai import AzureOpenAI
+from azure.core.pipeline.transport import AioHttpTransport
+from openai import AsyncAzureOpenAI
 
 # Application insights
 from opencensus.ext.azure.log_exporter import AzureLogHandler
@@ -31,7 +43,8 @@ from opencensus.trace.samplers import ProbabilitySampler
 app = FastAPI(
     title="AI Personal Health Companion API",
     description="Backend API for analyzing food images and medical documents",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS configuration
@@ -43,6 +56,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger replies such as history with OCR text; small ones are not worth it
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+
 # Security
 security = HTTPBearer()
 
@@ -51,29 +67,125 @@ AZURE_CLIENT_ID = os.getenv("AZURE_CLIENT_ID")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 COSMOS_DB_ENDPOINT = os.getenv("COSMOS_DB_ENDPOINT")
 STORAGE_ACCOUNT_ENDPOINT = os.getenv("STORAGE_ACCOUNT_ENDPOINT")
-KEY_VAULT_URL = os.getenv("KEY_VAULT_URL")
 APPLICATIONINSIGHTS_CONNECTION_STRING = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
 
-# Initialize Azure services with Managed Identity
-credential = DefaultAzureCredential(managed_identity_client_id=AZURE_CLIENT_ID)
+# Fraction of requests traced to Application Insights
+TRACE_SAMPLING_RATE = float(os.getenv("TRACE_SAMPLING_RATE", "0.1"))
 
-# Initialize clients
-blob_service_client = BlobServiceClient(
-    account_url=STORAGE_ACCOUNT_ENDPOINT,
-    credential=credential
-)
+# Cosmos DB database and containers
+DATABASE_NAME = "HealthCompanion"
+FOOD_CONTAINER = "FoodHistory"
+MEDICAL_CONTAINER = "MedicalRecords"
+RECOMMENDATIONS_CONTAINER = "Recommendations"
+ACTIVE_USERS_CONTAINER = "ActiveUsers"
+
+# Users drop out of ActiveUsers after this long without an upload
+ACTIVE_USER_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Each OpenAI attempt may take OPENAI_TIMEOUT_SECONDS and a timed-out or throttled call
+# is retried once, so a completion can hold a request for about 2 x 60 s plus backoff
+OPENAI_TIMEOUT_SECONDS = 60.0
+OPENAI_MAX_RETRIES = 1
+
+# Maximum number of Vision object / tag names included in a prompt
+VISION_PROMPT_MAX_NAMES = 10
+
+# Prompt templates, filled in per request with str.format_map
+FOOD_ANALYSIS_PROMPT = """
+Analyze this food image and provide:
+1. Identified food items
+2. Estimated nutritional information (calories, macros)
+3. Health recommendations
+
+Vision analysis results:
+Caption: {caption}
+Objects: {objects}
+Tags: {tags}
+
+Additional notes: {notes}
+
+Provide response in JSON format with keys: food_items, nutrition_info, recommendations
+"""
 
-cosmos_client = CosmosClient(
-    url=COSMOS_DB_ENDPOINT,
-    credential=credential
+MEDICAL_ANALYSIS_PROMPT = """
+Analyze this medical document and provide:
+1. Key medical findings
+2. Health recommendations based on the findings
+3. Important values or metrics mentioned
+
+Document type: {document_type}
+Extracted text:
+{extracted_text}
+
+Provide response in JSON format with keys: key_findings, recommendations, important_metrics
+"""
+
+RECOMMENDATIONS_PROMPT = """
+Generate personalized health recommendations for this user based on their history:
+
+Recent Food History:
+{food_history}
+
+Medical History:
+{medical_history}
+
+Additional Context: {context}
+
+Provide specific, actionable recommendations with rationale.
+Response format: {{"recommendations": ["rec1", "rec2", ...], "rationale": "explanation"}}
+"""
+
+# Recent history used as recommendation context: only the fields the prompt needs, never OCR text
+FOOD_CONTEXT_QUERY = (
+    "SELECT c.timestamp, c.foodItems FROM c "
+    "WHERE c.userId = @userId ORDER BY c.timestamp DESC OFFSET 0 LIMIT @limit"
+)
+MEDICAL_CONTEXT_QUERY = (
+    "SELECT c.timestamp, c.keyFindings, c.importantMetrics FROM c "
+    "WHERE c.userId = @userId ORDER BY c.timestamp DESC OFFSET 0 LIMIT @limit"
 )
 
-keyvault_client = SecretClient(
-    vault_url=KEY_VAULT_URL,
-    credential=credential
+# History pages only carry the fields the history views display (no OCR text, blob URLs, ...)
+FOOD_HISTORY_PAGE_QUERY = (
+    "SELECT c.id, c.timestamp, c.type, c.notes, c.foodItems, c.nutritionInfo, c.recommendations "
+    "FROM c WHERE c.userId = @userId ORDER BY c.timestamp DESC"
+)
+MEDICAL_HISTORY_PAGE_QUERY = (
+    "SELECT c.id, c.timestamp, c.type, c.documentType, c.keyFindings, c.importantMetrics, c.recommendations "
+    "FROM c WHERE c.userId = @userId ORDER BY c.timestamp DESC"
 )
+RECOMMENDATIONS_HISTORY_PAGE_QUERY = (
+    "SELECT c.id, c.timestamp, c.type, c.recommendations, c.rationale "
+    "FROM c WHERE c.userId = @userId ORDER BY c.timestamp DESC"
+)
+
+# Vision reads uploads from storage through short-lived SAS URLs signed with a
+# user delegation key, which is reused until shortly before it expires
+BLOB_SAS_LIFETIME = timedelta(minutes=5)
+USER_DELEGATION_KEY_LIFETIME = timedelta(hours=1)
+
+# Larger uploads are sent to blob storage as parallel 4 MB block PUTs
+BLOB_BLOCK_SIZE = 4 * 1024 * 1024
+BLOB_UPLOAD_CONCURRENCY = 8
+
+# Keep uploads up to 16 MB in memory before spooling them to disk (Starlette's default is 1 MB)
+MultiPartParser.max_file_size = 16 * 1024 * 1024
+
+# Azure clients (async SDKs, created on startup and closed on shutdown)
+credential = None
+blob_service_client = None
+cosmos_client = None
+cosmos_http_session = None
+
+# References to in-flight background writes so they are not garbage collected
+background_tasks = set()
+
+# Cached user delegation key for signing blob SAS URLs
+user_delegation_key = None
+user_delegation_key_expiry = None
 
 # Initialize AI clients (will be set up in startup)
+openai_http_client = None
 openai_client = None
 vision_client = None
 
@@ -90,12 +202,24 @@ if APPLICATIONINSIGHTS_CONNECTION_STRING:
         exporter=trace_exporter.AzureExporter(
             connection_string=APPLICATIONINSIGHTS_CONNECTION_STRING
         ),
-        sampler=ProbabilitySampler(1.0)
+        sampler=ProbabilitySampler(TRACE_SAMPLING_RATE)
     )
 else:
     logger = logging.getLogger(__name__)
     tracer = None
 
+# Markdown code fences the model sometimes wraps around its JSON output
+_FENCE_RE = re.compile(r"^```(?:json)?|```$", re.M)
+
+def parse_ai_json(content: str) -> dict:
+    """Parse a JSON object returned by the model, tolerating markdown fences"""
+    content = _FENCE_RE.sub("", content).strip()
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        # Fall back to the stdlib parser, which accepts a few inputs orjson rejects (e.g. NaN)
+        return json.loads(content)
+
 # Pydantic models
 class FoodAnalysisRequest(BaseModel):
     user_id: str
@@ -130,48 +254,193 @@ class HealthRecommendationResponse(BaseModel):
     rationale: str
     timestamp: datetime
 
-# Database references
-database = cosmos_client.get_database_client("HealthCompanion")
-food_container = database.get_container_client("FoodHistory")
-medical_container = database.get_container_client("MedicalRecords")
-recommendations_container = database.get_container_client("Recommendations")
+# Database references (set up in startup)
+database = None
+
+@lru_cache(maxsize=8)
+def get_container(name: str):
+    """Return the container client for a Cosmos DB container, created once per process"""
+    return database.get_container_client(name)
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize AI services on startup"""
-    global openai_client, vision_client
+    """Initialize Azure and AI services on startup"""
+    global credential, blob_service_client, cosmos_client, cosmos_http_session
+    global database
+    global openai_http_client, openai_client, vision_client
     
     try:
-        # Get OpenAI API key from Key Vault
-        openai_key_secret = await asyncio.to_thread(
-            keyvault_client.get_secret, "openai-api-key"
+        # Initialize Azure services with Managed Identity; one credential (and its
+        # token cache) is shared by every client
+        if AZURE_CLIENT_ID:
+            credential = ManagedIdentityCredential(client_id=AZURE_CLIENT_ID)
+        else:
+            # Local development: fall back to the developer's Azure CLI / environment login
+            credential = DefaultAzureCredential()
+        
+        blob_service_client = BlobServiceClient(
+            account_url=STORAGE_ACCOUNT_ENDPOINT,
+            credential=credential,
+            max_single_put_size=BLOB_BLOCK_SIZE,
+            max_block_size=BLOB_BLOCK_SIZE
+        )
+        
+        # Dedicated connection pool for Cosmos DB with long-lived keep-alive connections
+        cosmos_http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=200,
+                limit_per_host=64,
+                keepalive_timeout=120,
+                ttl_dns_cache=300,
+                enable_cleanup_closed=True
+            )
+        )
+        
+        cosmos_client = CosmosClient(
+            url=COSMOS_DB_ENDPOINT,
+            credential=credential,
+            transport=AioHttpTransport(session=cosmos_http_session, session_owner=False)
         )
         
-        # Initialize OpenAI client
-        openai_client = AzureOpenAI(
+        database = cosmos_client.get_database_client(DATABASE_NAME)
+        get_container.cache_clear()
+        
+        # HTTP/2 lets concurrent completion calls share one multiplexed connection
+        openai_http_client = httpx.AsyncClient(http2=True, timeout=httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=5.0))
+        
+        # The AI Services account has local (key) auth disabled, so OpenAI and Vision
+        # authenticate with managed identity tokens from the shared credential
+        openai_client = AsyncAzureOpenAI(
             azure_endpoint=AZURE_OPENAI_ENDPOINT,
-            api_key=openai_key_secret.value,
-            api_version="2024-02-01"
+            azure_ad_token_provider=get_bearer_token_provider(
+                credential, "https://cognitiveservices.azure.com/.default"
+            ),
+            api_version="2024-02-01",
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=openai_http_client
         )
         
-        # Initialize Vision client
         vision_client = ImageAnalysisClient(
             endpoint=AZURE_OPENAI_ENDPOINT,
-            credential=AzureKeyCredential(openai_key_secret.value)
+            credential=credential
         )
         
         logger.info("AI services initialized successfully")
         
     except Exception as e:
-        logger.error(f"Failed to initialize AI services: {str(e)}")
+        logger.error("Failed to initialize AI services: %s", e)
         raise
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Flush pending writes and close Azure clients on shutdown"""
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    
+    # Closing the OpenAI client also closes its shared HTTP/2 connection pool
+    for client in (openai_client, vision_client, cosmos_client, blob_service_client, credential):
+        if client is not None:
+            await client.close()
+    
+    if cosmos_http_session is not None:
+        await cosmos_http_session.close()
+    
+    get_container.cache_clear()
+    
+    logger.info("Azure clients closed")
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Extract user information from JWT token"""
     # In production, implement proper JWT validation
     # For now, return a mock user
     return {"user_id": "user123", "email": "user@example.com"}
 
+async def get_user_delegation_key():
+    """Return a cached user delegation key, requesting a new one when it is close to expiry"""
+    global user_delegation_key, user_delegation_key_expiry
+    
+    now = datetime.utcnow()
+    if user_delegation_key is None or user_delegation_key_expiry - now < BLOB_SAS_LIFETIME:
+        user_delegation_key_expiry = now + USER_DELEGATION_KEY_LIFETIME
+        user_delegation_key = await blob_service_client.get_user_delegation_key(now, user_delegation_key_expiry)
+    return user_delegation_key
+
+async def get_blob_read_url(blob_client) -> str:
+    """Return a short-lived, read-only SAS URL for a blob"""
+    sas_token = generate_blob_sas(
+        account_name=blob_client.account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        user_delegation_key=await get_user_delegation_key(),
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.utcnow() + BLOB_SAS_LIFETIME
+    )
+    return f"{blob_client.url}?{sas_token}"
+
+async def store_and_analyze_upload(file: UploadFile, blob_client, visual_features):
+    """Upload a file to blob storage and run Vision analysis on it"""
+    # Stream the file to blob storage without buffering it in memory
+    await file.seek(0)
+    await blob_client.upload_blob(
+        file.file,
+        length=file.size,
+        overwrite=True,
+        max_concurrency=BLOB_UPLOAD_CONCURRENCY
+    )
+    
+    # Vision fetches the image from storage, so the bytes are not sent a second time
+    image_url = await get_blob_read_url(blob_client)
+    return await vision_client.analyze_from_url(
+        image_url=image_url,
+        visual_features=visual_features
+    )
+
+async def query_user_items(container, query: str, user_id: str, limit: int) -> list:
+    """Run a query bound to @userId and @limit and collect the results"""
+    parameters = [
+        {"name": "@userId", "value": user_id},
+        {"name": "@limit", "value": limit}
+    ]
+    # Containers are partitioned by /userId, so the query stays within one partition
+    return [item async for item in container.query_items(
+        query=query,
+        parameters=parameters,
+        partition_key=user_id
+    )]
+
+async def query_user_page(container, query: str, user_id: str, page_size: int, continuation_token: Optional[str] = None):
+    """Fetch one page of a query bound to @userId, returning the items and the next continuation token"""
+    pager = container.query_items(
+        query=query,
+        parameters=[{"name": "@userId", "value": user_id}],
+        partition_key=user_id,
+        max_item_count=page_size
+    ).by_page(continuation_token)
+    
+    async for page in pager:
+        return [item async for item in page], pager.continuation_token
+    return [], None
+
+def mark_user_active(user_id: str, now: datetime):
+    """Record that a user uploaded something, for the processor's scheduled jobs"""
+    return get_container(ACTIVE_USERS_CONTAINER).upsert_item({
+        "id": user_id,
+        "userId": user_id,
+        "lastSeen": now.isoformat(),
+        "ttl": ACTIVE_USER_TTL_SECONDS
+    })
+
+def run_in_background(coro):
+    """Schedule a coroutine without waiting for its result"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+
+def _on_background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Background task failed: %s", task.exception())
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -184,43 +453,32 @@ async def analyze_food_image(
     current_user: dict = Depends(get_current_user)
 ):
     """Analyze uploaded food image and provide nutritional insights"""
+    now = datetime.utcnow()
     try:
-        # Upload image to blob storage
-        blob_name = f"food-images/{current_user['user_id']}/{datetime.utcnow().isoformat()}-{file.filename}"
+        # Upload image to blob storage; the date prefix lets cleanup list blobs by day
+        blob_name = f"{now:%Y/%m/%d}/{current_user['user_id']}/{now.isoformat()}-{file.filename}"
         blob_client = blob_service_client.get_blob_client(
             container="food-images",
             blob=blob_name
         )
         
-        # Upload file
-        file_content = await file.read()
-        blob_client.upload_blob(file_content, overwrite=True)
-        image_url = blob_client.url
-        
-        # Analyze image with Azure AI Vision
-        vision_result = vision_client.analyze(
-            image_data=file_content,
-            visual_features=[VisualFeatures.OBJECTS, VisualFeatures.TAGS, VisualFeatures.CAPTION]
+        # Upload file and analyze image with Azure AI Vision
+        vision_result = await store_and_analyze_upload(
+            file,
+            blob_client,
+            [VisualFeatures.OBJECTS, VisualFeatures.TAGS, VisualFeatures.CAPTION]
         )
+        image_url = blob_client.url
         
         # Generate nutritional analysis with OpenAI
-        analysis_prompt = f"""
-        Analyze this food image and provide:
-        1. Identified food items
-        2. Estimated nutritional information (calories, macros)
-        3. Health recommendations
-        
-        Vision analysis results:
-        Caption: {vision_result.caption.text if vision_result.caption else 'N/A'}
-        Objects: {[obj.tags[0].name for obj in vision_result.objects] if vision_result.objects else []}
-        Tags: {[tag.name for tag in vision_result.tags[:10]] if vision_result.tags else []}
-        
-        Additional notes: {notes}
-        
-        Provide response in JSON format with keys: food_items, nutrition_info, recommendations
-        """
-        
-        response = openai_client.chat.completions.create(
+        analysis_prompt = FOOD_ANALYSIS_PROMPT.format_map({
+            "caption": vision_result.caption.text if vision_result.caption else "N/A",
+            "objects": ", ".join(islice((obj.tags[0].name for obj in (vision_result.objects.list if vision_result.objects else ()) if obj.tags), VISION_PROMPT_MAX_NAMES)),
+            "tags": ", ".join(islice((tag.name for tag in (vision_result.tags.list if vision_result.tags else ())), VISION_PROMPT_MAX_NAMES)),
+            "notes": notes
+        })
+        
+        response = await openai_client.chat.completions.create(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "You are a nutritionist AI assistant."},
@@ -229,36 +487,37 @@ async def analyze_food_image(
             temperature=0.3
         )
         
-        # Parse AI response (implement proper JSON parsing)
-        ai_analysis = eval(response.choices[0].message.content)  # Use json.loads in production
+        # Parse AI response
+        ai_analysis = parse_ai_json(response.choices[0].message.content)
         
-        # Save to Cosmos DB
+        # Save to Cosmos DB without delaying the response
         analysis_record = {
-            "id": f"{current_user['user_id']}-{datetime.utcnow().timestamp()}",
+            "id": f"{current_user['user_id']}-{time.time_ns()}",
             "userId": current_user['user_id'],
             "imageUrl": image_url,
             "notes": notes,
             "foodItems": ai_analysis.get("food_items", []),
             "nutritionInfo": ai_analysis.get("nutrition_info", {}),
             "recommendations": ai_analysis.get("recommendations", []),
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": now.isoformat(),
             "type": "food_analysis"
         }
         
-        food_container.create_item(analysis_record)
+        run_in_background(get_container(FOOD_CONTAINER).create_item(analysis_record))
+        run_in_background(mark_user_active(current_user['user_id'], now))
         
-        logger.info(f"Food analysis completed for user {current_user['user_id']}")
+        logger.info("Food analysis completed for user %s", current_user['user_id'], extra={"custom_dimensions": {"userId": current_user['user_id']}})
         
         return FoodAnalysisResponse(
             analysis_id=analysis_record["id"],
             food_items=ai_analysis.get("food_items", []),
             nutrition_info=ai_analysis.get("nutrition_info", {}),
             recommendations=ai_analysis.get("recommendations", []),
-            timestamp=datetime.utcnow()
+            timestamp=now
         )
         
     except Exception as e:
-        logger.error(f"Food analysis failed: {str(e)}")
+        logger.error("Food analysis failed: %s", e, extra={"custom_dimensions": {"userId": current_user['user_id']}})
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
 @app.post("/api/analyze-medical-document", response_model=MedicalDocumentResponse)
@@ -268,46 +527,36 @@ async def analyze_medical_document(
     current_user: dict = Depends(get_current_user)
 ):
     """Analyze uploaded medical document and extract key information"""
+    now = datetime.utcnow()
     try:
-        # Upload document to blob storage
-        blob_name = f"medical-documents/{current_user['user_id']}/{datetime.utcnow().isoformat()}-{file.filename}"
+        # Upload document to blob storage; the date prefix lets cleanup list blobs by day
+        blob_name = f"{now:%Y/%m/%d}/{current_user['user_id']}/{now.isoformat()}-{file.filename}"
         blob_client = blob_service_client.get_blob_client(
             container="medical-documents",
             blob=blob_name
         )
         
-        # Upload file
-        file_content = await file.read()
-        blob_client.upload_blob(file_content, overwrite=True)
-        document_url = blob_client.url
-        
-        # Extract text with Azure AI Vision (OCR)
-        vision_result = vision_client.analyze(
-            image_data=file_content,
-            visual_features=[VisualFeatures.READ]
+        # Upload file and extract text with Azure AI Vision (OCR)
+        vision_result = await store_and_analyze_upload(
+            file,
+            blob_client,
+            [VisualFeatures.READ]
         )
+        document_url = blob_client.url
         
         extracted_text = ""
         if vision_result.read:
-            for page in vision_result.read.blocks:
-                for line in page.lines:
-                    extracted_text += line.text + "\n"
+            extracted_text = "".join(
+                line.text + "\n" for block in vision_result.read.blocks for line in block.lines
+            )
         
         # Analyze medical content with OpenAI
-        analysis_prompt = f"""
-        Analyze this medical document and provide:
-        1. Key medical findings
-        2. Health recommendations based on the findings
-        3. Important values or metrics mentioned
-        
-        Document type: {document_type}
-        Extracted text:
-        {extracted_text}
+        analysis_prompt = MEDICAL_ANALYSIS_PROMPT.format_map({
+            "document_type": document_type,
+            "extracted_text": extracted_text
+        })
         
-        Provide response in JSON format with keys: key_findings, recommendations, important_metrics
-        """
-        
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "You are a medical AI assistant. Provide analysis for informational purposes only."},
@@ -317,11 +566,11 @@ async def analyze_medical_document(
         )
         
         # Parse AI response
-        ai_analysis = eval(response.choices[0].message.content)  # Use json.loads in production
+        ai_analysis = parse_ai_json(response.choices[0].message.content)
         
-        # Save to Cosmos DB
+        # Save to Cosmos DB without delaying the response
         document_record = {
-            "id": f"{current_user['user_id']}-doc-{datetime.utcnow().timestamp()}",
+            "id": f"{current_user['user_id']}-doc-{time.time_ns()}",
             "userId": current_user['user_id'],
             "documentUrl": document_url,
             "documentType": document_type,
@@ -329,24 +578,25 @@ async def analyze_medical_document(
             "keyFindings": ai_analysis.get("key_findings", []),
             "recommendations": ai_analysis.get("recommendations", []),
             "importantMetrics": ai_analysis.get("important_metrics", {}),
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": now.isoformat(),
             "type": "medical_document"
         }
         
-        medical_container.create_item(document_record)
+        run_in_background(get_container(MEDICAL_CONTAINER).create_item(document_record))
+        run_in_background(mark_user_active(current_user['user_id'], now))
         
-        logger.info(f"Medical document analysis completed for user {current_user['user_id']}")
+        logger.info("Medical document analysis completed for user %s", current_user['user_id'], extra={"custom_dimensions": {"userId": current_user['user_id']}})
         
         return MedicalDocumentResponse(
             document_id=document_record["id"],
             extracted_text=extracted_text,
             key_findings=ai_analysis.get("key_findings", []),
             recommendations=ai_analysis.get("recommendations", []),
-            timestamp=datetime.utcnow()
+            timestamp=now
         )
         
     except Exception as e:
-        logger.error(f"Medical document analysis failed: {str(e)}")
+        logger.error("Medical document analysis failed: %s", e, extra={"custom_dimensions": {"userId": current_user['user_id']}})
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
 @app.post("/api/get-recommendations", response_model=HealthRecommendationResponse)
@@ -355,38 +605,35 @@ async def get_health_recommendations(
     current_user: dict = Depends(get_current_user)
 ):
     """Generate personalized health recommendations based on user history"""
+    now = datetime.utcnow()
     try:
-        # Query user's food history
-        food_history = list(food_container.query_items(
-            query="SELECT * FROM c WHERE c.userId = @userId ORDER BY c.timestamp DESC OFFSET 0 LIMIT 10",
-            parameters=[{"name": "@userId", "value": current_user['user_id']}],
-            enable_cross_partition_query=True
-        ))
-        
-        # Query user's medical records
-        medical_history = list(medical_container.query_items(
-            query="SELECT * FROM c WHERE c.userId = @userId ORDER BY c.timestamp DESC OFFSET 0 LIMIT 5",
-            parameters=[{"name": "@userId", "value": current_user['user_id']}],
-            enable_cross_partition_query=True
-        ))
-        
-        # Generate personalized recommendations
-        context_prompt = f"""
-        Generate personalized health recommendations for this user based on their history:
-        
-        Recent Food History:
-        {food_history[:5]}  # Last 5 food analyses
-        
-        Medical History:
-        {medical_history[:3]}  # Last 3 medical documents
+        # Query user's food history and medical records concurrently
+        food_history, medical_history = await asyncio.gather(
+            query_user_items(get_container(FOOD_CONTAINER), FOOD_CONTEXT_QUERY, current_user['user_id'], 5),
+            query_user_items(get_container(MEDICAL_CONTAINER), MEDICAL_CONTEXT_QUERY, current_user['user_id'], 3)
+        )
         
-        Additional Context: {request.context or 'General health recommendations'}
+        food_summary = [
+            {"timestamp": record.get("timestamp"), "items": record.get("foodItems", [])}
+            for record in food_history
+        ]
+        medical_summary = [
+            {
+                "timestamp": record.get("timestamp"),
+                "key_findings": record.get("keyFindings", []),
+                "important_metrics": record.get("importantMetrics", {})
+            }
+            for record in medical_history
+        ]
         
-        Provide specific, actionable recommendations with rationale.
-        Response format: {{"recommendations": ["rec1", "rec2", ...], "rationale": "explanation"}}
-        """
+        # Generate personalized recommendations
+        context_prompt = RECOMMENDATIONS_PROMPT.format_map({
+            "food_history": orjson.dumps(food_summary).decode(),
+            "medical_history": orjson.dumps(medical_summary).decode(),
+            "context": request.context or "General health recommendations"
+        })
         
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "You are a personalized health AI assistant."},
@@ -396,80 +643,72 @@ async def get_health_recommendations(
         )
         
         # Parse AI response
-        ai_recommendations = eval(response.choices[0].message.content)  # Use json.loads in production
+        ai_recommendations = parse_ai_json(response.choices[0].message.content)
         
         # Save recommendations
         recommendation_record = {
-            "id": f"{current_user['user_id']}-rec-{datetime.utcnow().timestamp()}",
+            "id": f"{current_user['user_id']}-rec-{time.time_ns()}",
             "userId": current_user['user_id'],
             "recommendations": ai_recommendations.get("recommendations", []),
             "rationale": ai_recommendations.get("rationale", ""),
             "context": request.context,
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": now.isoformat(),
             "type": "health_recommendations"
         }
         
-        recommendations_container.create_item(recommendation_record)
+        run_in_background(get_container(RECOMMENDATIONS_CONTAINER).create_item(recommendation_record))
         
-        logger.info(f"Health recommendations generated for user {current_user['user_id']}")
+        logger.info("Health recommendations generated for user %s", current_user['user_id'], extra={"custom_dimensions": {"userId": current_user['user_id']}})
         
         return HealthRecommendationResponse(
             recommendations=ai_recommendations.get("recommendations", []),
             rationale=ai_recommendations.get("rationale", ""),
-            timestamp=datetime.utcnow()
+            timestamp=now
         )
         
     except Exception as e:
-        logger.error(f"Recommendation generation failed: {str(e)}")
+        logger.error("Recommendation generation failed: %s", e, extra={"custom_dimensions": {"userId": current_user['user_id']}})
         raise HTTPException(status_code=500, detail=f"Recommendation generation failed: {str(e)}")
 
 @app.get("/api/user-history")
 async def get_user_history(
     limit: int = 20,
+    food_continuation: Optional[str] = None,
+    medical_continuation: Optional[str] = None,
+    recommendations_continuation: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    """Get user's complete health history"""
+    """Get one page of the user's health history; pass back the continuation tokens for the next page"""
     try:
-        # Get food history
-        food_history = list(food_container.query_items(
-            query="SELECT * FROM c WHERE c.userId = @userId ORDER BY c.timestamp DESC OFFSET 0 LIMIT @limit",
-            parameters=[
-                {"name": "@userId", "value": current_user['user_id']},
-                {"name": "@limit", "value": limit}
-            ],
-            enable_cross_partition_query=True
-        ))
-        
-        # Get medical history
-        medical_history = list(medical_container.query_items(
-            query="SELECT * FROM c WHERE c.userId = @userId ORDER BY c.timestamp DESC OFFSET 0 LIMIT @limit",
-            parameters=[
-                {"name": "@userId", "value": current_user['user_id']},
-                {"name": "@limit", "value": limit}
-            ],
-            enable_cross_partition_query=True
-        ))
-        
-        # Get recommendations history
-        recommendations_history = list(recommendations_container.query_items(
-            query="SELECT * FROM c WHERE c.userId = @userId ORDER BY c.timestamp DESC OFFSET 0 LIMIT @limit",
-            parameters=[
-                {"name": "@userId", "value": current_user['user_id']},
-                {"name": "@limit", "value": limit}
-            ],
-            enable_cross_partition_query=True
-        ))
+        # Query all three containers concurrently
+        (food_history, food_token), (medical_history, medical_token), (recommendations_history, recommendations_token) = await asyncio.gather(
+            query_user_page(get_container(FOOD_CONTAINER), FOOD_HISTORY_PAGE_QUERY, current_user['user_id'], limit, food_continuation),
+            query_user_page(get_container(MEDICAL_CONTAINER), MEDICAL_HISTORY_PAGE_QUERY, current_user['user_id'], limit, medical_continuation),
+            query_user_page(get_container(RECOMMENDATIONS_CONTAINER), RECOMMENDATIONS_HISTORY_PAGE_QUERY, current_user['user_id'], limit, recommendations_continuation)
+        )
         
         return {
             "food_history": food_history,
             "medical_history": medical_history,
-            "recommendations_history": recommendations_history
+            "recommendations_history": recommendations_history,
+            "continuation_tokens": {
+                "food": food_token,
+                "medical": medical_token,
+                "recommendations": recommendations_token
+            }
         }
         
     except Exception as e:
-        logger.error(f"History retrieval failed: {str(e)}")
+        logger.error("History retrieval failed: %s", e, extra={"custom_dimensions": {"userId": current_user['user_id']}})
         raise HTTPException(status_code=500, detail=f"History retrieval failed: {str(e)}")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "0")) or os.cpu_count() or 1,
+        loop="uvloop",
+        http="httptools"
+    )
@@ -6,18 +6,33 @@ import os
 import logging
 from datetime import datetime, timedelta
 from typing import List, Dict, Any
+import io
 import json
+import hashlib
+import re
+from collections import Counter, OrderedDict, deque
+from itertools import islice
+from contextlib import AsyncExitStack
+
+import aiohttp
+import httpx
+from PIL import Image, ImageOps
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 # Azure SDK imports
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient
-from azure.cosmos import CosmosClient
-from azure.keyvault.secrets import SecretClient
-from azure.ai.vision.imageanalysis import ImageAnalysisClient
+from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+from azure.storage.blob.aio import BlobServiceClient, BlobPrefix
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import CosmosBatchOperationError, CosmosHttpResponseError
+from azure.ai.vision.imageanalysis.aio import ImageAnalysisClient
 from azure.ai.vision.imageanalysis.models import VisualFeatures
-from azure.core.credentials import AzureKeyCredential
-from openai import AzureOpenAI
-from azure.servicebus import ServiceBusClient, ServiceBusMessage
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.core.pipeline.transport import AioHttpTransport
+from openai import APIConnectionError, AsyncAzureOpenAI, InternalServerError, RateLimitError
+from azure.servicebus.aio import ServiceBusClient, AutoLockRenewer
 
 # Application insights
 from opencensus.ext.azure.log_exporter import AzureLogHandler
@@ -27,36 +42,27 @@ from opencensus.trace.tracer import Tracer
 # Configuration
 AZURE_CLIENT_ID = os.getenv("AZURE_CLIENT_ID")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
+AZURE_VISION_ENDPOINT = os.getenv("AZURE_VISION_ENDPOINT")
+AZURE_OPENAI_BATCH_DEPLOYMENT = os.getenv("AZURE_OPENAI_BATCH_DEPLOYMENT", "gpt-4")
 COSMOS_DB_ENDPOINT = os.getenv("COSMOS_DB_ENDPOINT")
 STORAGE_ACCOUNT_ENDPOINT = os.getenv("STORAGE_ACCOUNT_ENDPOINT")
-KEY_VAULT_URL = os.getenv("KEY_VAULT_URL")
 SERVICE_BUS_CONNECTION_STRING = os.getenv("SERVICE_BUS_CONNECTION_STRING")
 APPLICATIONINSIGHTS_CONNECTION_STRING = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
 
-# Initialize Azure services with Managed Identity
-credential = DefaultAzureCredential(managed_identity_client_id=AZURE_CLIENT_ID)
+# Users drop out of ActiveUsers after this long without an upload
+ACTIVE_USER_TTL_SECONDS = 30 * 24 * 60 * 60
 
-# Initialize clients
-blob_service_client = BlobServiceClient(
-    account_url=STORAGE_ACCOUNT_ENDPOINT,
-    credential=credential
-)
+# Azure clients (async SDKs, initialized on startup and owned by the processor)
+credential = None
+blob_service_client = None
+cosmos_client = None
+food_container = None
+medical_container = None
+recommendations_container = None
+active_users_container = None
 
-cosmos_client = CosmosClient(
-    url=COSMOS_DB_ENDPOINT,
-    credential=credential
-)
-
-keyvault_client = SecretClient(
-    vault_url=KEY_VAULT_URL,
-    credential=credential
-)
-
-# Service Bus client for message processing
-if SERVICE_BUS_CONNECTION_STRING:
-    servicebus_client = ServiceBusClient.from_connection_string(SERVICE_BUS_CONNECTION_STRING)
-else:
-    servicebus_client = None
+# Service Bus client for message processing (only when a connection string is configured)
+servicebus_client = None
 
 # AI clients (will be initialized on startup)
 openai_client = None
@@ -80,148 +86,673 @@ else:
     logger = logging.getLogger(__name__)
     tracer = None
 
-# Database references
-database = cosmos_client.get_database_client("HealthCompanion")
-food_container = database.get_container_client("FoodHistory")
-medical_container = database.get_container_client("MedicalRecords")
-recommendations_container = database.get_container_client("Recommendations")
+# Food images are shrunk before Vision, whose object, tag and caption features do not
+# improve past this size; smaller uploads are sent unchanged
+VISION_MAX_IMAGE_EDGE = 1024
+VISION_JPEG_QUALITY = 85
+VISION_RESIZE_MIN_BYTES = 512 * 1024
+
+# Maximum number of Vision object / tag names included in a prompt
+VISION_PROMPT_MAX_NAMES = 10
+
+# Prompt templates, filled in per item with str.format_map
+FOOD_ANALYSIS_SYSTEM_PROMPT = "You are an expert nutritionist and health analyst."
+FOOD_ANALYSIS_PROMPT = """
+Analyze this food image and provide detailed nutritional information:
+
+Vision analysis:
+Caption: {caption}
+Objects: {objects}
+Tags: {tags}
+
+Provide comprehensive analysis including:
+1. Detailed food identification
+2. Nutritional breakdown (calories, macros, micros)
+3. Health assessment
+4. Personalized recommendations
+
+Format as JSON with keys: food_items, nutrition_info, health_assessment, recommendations
+"""
+
+MEDICAL_ANALYSIS_SYSTEM_PROMPT = "You are a medical AI assistant. Provide analysis for informational purposes only."
+MEDICAL_ANALYSIS_PROMPT = """
+Analyze this medical document and provide comprehensive medical insights:
+
+Document Type: {document_type}
+Extracted Text:
+{extracted_text}
+
+Provide detailed analysis including:
+1. Key medical findings and abnormalities
+2. Important metrics and values
+3. Risk assessment
+4. Recommended follow-up actions
+5. Lifestyle recommendations
+
+Format as JSON with keys: key_findings, metrics, risk_assessment, follow_up_actions, lifestyle_recommendations
+"""
+
+DAILY_INSIGHTS_SYSTEM_PROMPT = "You are a comprehensive health AI analyst providing personalized insights."
+DAILY_INSIGHTS_PROMPT = """
+Generate comprehensive daily health insights for this user based on their recent activity:
+
+Recent Food History (last 7 days):
+{food_history}
+
+Recent Medical Data (last 7 days):
+{medical_history}
+
+Provide insights including:
+1. Nutritional trends and patterns
+2. Health improvements or concerns
+3. Personalized recommendations for today
+4. Long-term health goals suggestions
+5. Risk factors and preventive measures
+
+Format as JSON with keys: nutritional_trends, health_status, daily_recommendations, long_term_goals, risk_factors
+"""
+
+HEALTH_TRENDS_SYSTEM_PROMPT = "You are an expert health trend analyst providing longitudinal health assessments."
+HEALTH_TRENDS_PROMPT = """
+Analyze long-term health trends for this user over the last 90 days:
+
+Food History Summary:
+{food_summary}
+
+Medical History Summary:
+{medical_summary}
+
+Provide comprehensive trend analysis including:
+1. Nutritional pattern changes over time
+2. Health metric improvements or deteriorations
+3. Behavioral pattern identification
+4. Risk trend assessment
+5. Long-term health trajectory prediction
+6. Personalized intervention recommendations
+
+Format as JSON with keys: nutritional_patterns, health_metrics_trend, behavioral_patterns, risk_trends, health_trajectory, interventions
+"""
+
+# Pending analyses only need the fields the handlers read; results are written as patches.
+# Items still pending after a week are abandoned and left to the cleanup job. The sort
+# leads with the equality-filtered status so the (status, timestamp) composite index serves it
+PENDING_SWEEP_WINDOW = timedelta(days=7)
+PENDING_FOOD_QUERY = (
+    "SELECT c.id, c.userId, c.imagePath, c.timestamp FROM c "
+    "WHERE c.status = 'pending' AND c.timestamp >= @cutoff ORDER BY c.status ASC, c.timestamp ASC"
+)
+PENDING_MEDICAL_QUERY = (
+    "SELECT c.id, c.userId, c.documentPath, c.documentType, c.timestamp FROM c "
+    "WHERE c.status = 'pending' AND c.timestamp >= @cutoff ORDER BY c.status ASC, c.timestamp ASC"
+)
+
+# Recent history quoted in the daily insights prompt, without OCR text or blob paths
+RECENT_FOOD_QUERY = (
+    "SELECT c.timestamp, c.foodItems, c.nutritionInfo, c.healthAssessment FROM c "
+    "WHERE c.userId = @userId AND c.timestamp >= @cutoff ORDER BY c.timestamp DESC"
+)
+RECENT_MEDICAL_QUERY = (
+    "SELECT c.timestamp, c.documentType, c.keyFindings, c.metrics, c.riskAssessment FROM c "
+    "WHERE c.userId = @userId AND c.timestamp >= @cutoff ORDER BY c.timestamp DESC"
+)
+
+# History folded into trend summaries: only the fields TrendAgg reads
+TREND_FOOD_QUERY = (
+    "SELECT c.timestamp, c.foodItems, c.nutritionInfo FROM c "
+    "WHERE c.userId = @userId AND c.timestamp >= @cutoff ORDER BY c.timestamp ASC"
+)
+TREND_MEDICAL_QUERY = (
+    "SELECT c.timestamp, c.documentType, c.keyFindings, c.metrics FROM c "
+    "WHERE c.userId = @userId AND c.timestamp >= @cutoff ORDER BY c.timestamp ASC"
+)
+
+# Number of documents fetched per Cosmos DB round trip; also bounds a delete batch,
+# which Cosmos DB limits to 100 operations
+QUERY_PAGE_SIZE = 100
+
+# Blobs larger than one chunk are downloaded as parallel ranged GETs
+BLOB_CHUNK_GET_SIZE = 16 * 1024 * 1024
+BLOB_DOWNLOAD_CONCURRENCY = 16
+
+# Maximum number of pending analyses processed at the same time
+ANALYSIS_CONCURRENCY = 16
+
+# Service Bus messages are prefetched and handled in concurrent batches; locks are
+# renewed while a message waits for a free analysis slot
+SERVICE_BUS_QUEUE_NAME = "health-notifications"
+SERVICE_BUS_BATCH_SIZE = 50
+SERVICE_BUS_MAX_WAIT_SECONDS = 5
+SERVICE_BUS_LOCK_RENEWAL_SECONDS = 10 * 60
+
+# Message types that have no handler yet; they are completed without dispatching
+UNIMPLEMENTED_MESSAGE_TYPES = frozenset({"urgent_health_alert", "daily_reminder"})
+
+# HTTP connections per host; sized so every concurrent analysis can run its
+# parallel blob download without waiting for a free socket
+HTTP_POOL_SIZE = ANALYSIS_CONCURRENCY * BLOB_DOWNLOAD_CONCURRENCY
+
+# The Azure clients share one connection pool: room for the blob downloads plus one
+# connection per concurrent analysis to each of Cosmos DB and Vision
+SHARED_HTTP_POOL_SIZE = HTTP_POOL_SIZE + 2 * ANALYSIS_CONCURRENCY
+HTTP_KEEPALIVE_SECONDS = 60
+
+# Number of GPT-4 replies kept for reuse by identical analysis prompts
+COMPLETION_CACHE_SIZE = 1024
+
+# Number of Vision results kept for reuse by retries of unchanged blobs
+VISION_CACHE_SIZE = 1024
+
+# Analysis results for the same user are upserted together in one transactional
+# batch, sent once it is full or has waited this long
+WRITE_BATCH_MAX_ITEMS = 100
+WRITE_BATCH_MAX_DELAY_SECONDS = 0.2
+
+# Daily insights and trend analyses run as OpenAI batch jobs, polled until they finish
+BATCH_POLL_INTERVAL_SECONDS = 60
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# Blobs are named yyyy/mm/dd/...; older uploads used the container name as prefix
+DATE_PREFIX_RE = re.compile(r"\d{4}(/\d{2}){0,2}")
+LEGACY_BLOB_PREFIXES = {"food-images": "food-images/", "medical-documents": "medical-documents/"}
+
+# Maximum number of deletes in one Blob Batch request
+BLOB_DELETE_BATCH_SIZE = 256
+
+# Most recent items quoted verbatim in a trend analysis prompt
+TREND_RECENT_ITEMS = 50
+
+def user_dimensions(user_id: str) -> Dict[str, Any]:
+    """Logging extra that attaches a user ID as an Application Insights custom dimension"""
+    return {"custom_dimensions": {"userId": user_id}}
+
+def item_dimensions(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Logging extra that attaches an item's user and ID as Application Insights custom dimensions"""
+    return {"custom_dimensions": {"userId": item.get('userId'), "itemId": item.get('id')}}
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether an analysis failure is throttling or an outage that a later retry may get past"""
+    # APIConnectionError also covers OpenAI timeouts
+    if isinstance(error, (RateLimitError, APIConnectionError, InternalServerError)):
+        return True
+    if isinstance(error, (ServiceRequestError, ServiceResponseError, aiohttp.ClientError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, HttpResponseError):
+        return error.status_code == 429 or (error.status_code or 0) >= 500
+    return False
+
+def create_http_session() -> aiohttp.ClientSession:
+    """Create the connection pool shared by every Azure SDK client"""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=SHARED_HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_SIZE,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS
+        )
+    )
+
+def create_transport(session: aiohttp.ClientSession) -> AioHttpTransport:
+    """Create an Azure SDK transport over the shared session; closing a client leaves the session open"""
+    return AioHttpTransport(session=session, session_owner=False)
+
+class BatchWriter:
+    """Coalesces partial updates to the same partition of a container into transactional batches"""
+    
+    def __init__(self, container):
+        self.container = container
+        self.buffers = {}
+        self.timers = {}
+    
+    async def patch(self, item: Dict[str, Any], fields: Dict[str, Any]):
+        """Queue setting fields on an existing item and wait until its batch has been written.
+        
+        Only the given fields are sent, so item may be a projection of the stored document.
+        A Cosmos DB patch holds at most 10 operations, i.e. 10 fields.
+        """
+        partition_key = item['userId']
+        operations = [{"op": "set", "path": f"/{name}", "value": value} for name, value in fields.items()]
+        written = asyncio.get_running_loop().create_future()
+        buffer = self.buffers.setdefault(partition_key, [])
+        buffer.append((item['id'], operations, written))
+        
+        if len(buffer) >= WRITE_BATCH_MAX_ITEMS:
+            await self.flush_partition(partition_key)
+        elif partition_key not in self.timers:
+            self.timers[partition_key] = asyncio.create_task(self.flush_later(partition_key))
+        
+        await written
+    
+    async def flush_later(self, partition_key: str):
+        await asyncio.sleep(WRITE_BATCH_MAX_DELAY_SECONDS)
+        self.timers.pop(partition_key, None)
+        await self.flush_partition(partition_key)
+    
+    async def flush_partition(self, partition_key: str):
+        """Write everything buffered for one partition"""
+        timer = self.timers.pop(partition_key, None)
+        if timer is not None:
+            timer.cancel()
+        
+        entries = self.buffers.pop(partition_key, [])
+        if not entries:
+            return
+        
+        try:
+            await self.container.execute_item_batch(
+                [("patch", (item_id, operations)) for item_id, operations, _ in entries],
+                partition_key=partition_key
+            )
+            for _, _, written in entries:
+                if not written.done():
+                    written.set_result(None)
+        except (CosmosBatchOperationError, CosmosHttpResponseError):
+            # A batch succeeds or fails as a whole; retry item by item so one bad
+            # document only fails its own analysis
+            for item_id, operations, written in entries:
+                if written.done():
+                    continue
+                try:
+                    await self.container.patch_item(
+                        item=item_id,
+                        partition_key=partition_key,
+                        patch_operations=operations
+                    )
+                    written.set_result(None)
+                except Exception as e:
+                    written.set_exception(e)
+        except Exception as e:
+            # Not a Cosmos DB rejection, so retrying per item would hide a broken batch path
+            logger.error(
+                "Batch write of %d items failed for user %s", len(entries), partition_key,
+                extra=user_dimensions(partition_key), exc_info=True
+            )
+            for _, _, written in entries:
+                if not written.done():
+                    written.set_exception(e)
+    
+    async def flush(self):
+        """Write every buffered item, regardless of age"""
+        await asyncio.gather(*(self.flush_partition(key) for key in list(self.buffers)))
+
+class LRUCache:
+    """Bounded in-process cache that evicts the least recently used entry"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+    
+    def get(self, key: str):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+    
+    def put(self, key: str, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+def numeric_fields(values: Dict[str, Any], prefix: str = ""):
+    """Yield (dotted name, number) pairs from a possibly nested dict of metrics.
+    
+    Values are model output, so anything that is not a dict yields nothing.
+    """
+    if not isinstance(values, dict):
+        return
+    for name, value in values.items():
+        if isinstance(value, dict):
+            yield from numeric_fields(value, f"{prefix}{name}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{name}", value
+
+class TrendAgg:
+    """Running summary of a user's history whose size does not grow with the history"""
+    
+    def __init__(self, metrics_field: str, compact, top_k: int = TREND_RECENT_ITEMS):
+        self.metrics_field = metrics_field
+        self.compact = compact
+        self.count = 0
+        self.daily_counts = Counter()
+        self.metric_totals = Counter()
+        self.recent = deque(maxlen=top_k)
+    
+    def update(self, item: Dict[str, Any]):
+        """Fold one item into the summary; items are expected oldest first"""
+        self.count += 1
+        self.daily_counts[(item.get('timestamp') or '')[:10]] += 1
+        for name, value in numeric_fields(item.get(self.metrics_field)):
+            self.metric_totals[name] += value
+        self.recent.append(self.compact(item))
+    
+    def to_summary_dict(self) -> Dict[str, Any]:
+        """Return the summary as a JSON-serializable dict for the trend prompt"""
+        active_days = len(self.daily_counts)
+        return {
+            'total_items': self.count,
+            'active_days': active_days,
+            'items_per_day': dict(sorted(self.daily_counts.items())),
+            'mean_per_active_day': {
+                name: round(total / active_days, 1) for name, total in self.metric_totals.items()
+            },
+            'most_recent': list(self.recent)
+        }
+
+def compact_food_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Reduce a food history item to what the trend prompt quotes"""
+    food_items = item.get('foodItems')
+    return {
+        'date': (item.get('timestamp') or '')[:10],
+        'foods': [
+            food.get('name', '') if isinstance(food, dict) else food
+            for food in (food_items if isinstance(food_items, list) else ())
+        ]
+    }
+
+def compact_medical_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Reduce a medical record to what the trend prompt quotes"""
+    key_findings = item.get('keyFindings')
+    return {
+        'date': (item.get('timestamp') or '')[:10],
+        'documentType': item.get('documentType', 'general'),
+        'keyFindings': key_findings[:5] if isinstance(key_findings, list) else []
+    }
+
+def downscale_image(data: bytes) -> bytes:
+    """Shrink an image to VISION_MAX_IMAGE_EDGE on its long edge, re-encoded as JPEG"""
+    if len(data) < VISION_RESIZE_MIN_BYTES:
+        return data
+    
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Let the JPEG decoder skip detail the thumbnail would discard anyway
+            image.draft("RGB", (VISION_MAX_IMAGE_EDGE, VISION_MAX_IMAGE_EDGE))
+            # Re-encoding drops EXIF, so apply its rotation to keep photos upright
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((VISION_MAX_IMAGE_EDGE, VISION_MAX_IMAGE_EDGE))
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    except OSError:
+        # Formats Pillow cannot decode go to Vision as uploaded
+        return data
+    
+    return buffer.getvalue()
+
+def extract_food_features(vision_result) -> Dict[str, Any]:
+    """Keep the parts of a Vision result used by the food analysis prompt"""
+    return {
+        'caption': vision_result.caption.text if vision_result.caption else 'N/A',
+        'objects': ", ".join(islice((obj.tags[0].name for obj in (vision_result.objects.list if vision_result.objects else ()) if obj.tags), VISION_PROMPT_MAX_NAMES)),
+        'tags': ", ".join(islice((tag.name for tag in (vision_result.tags.list if vision_result.tags else ())), VISION_PROMPT_MAX_NAMES))
+    }
+
+def extract_document_text(vision_result) -> str:
+    """Join the OCR lines of a Vision result into plain text"""
+    if not vision_result.read:
+        return ""
+    return "".join(f"{line.text}\n" for page in vision_result.read.blocks for line in page.lines)
+
+async def iter_stale_blob_prefixes(container_client, cutoff: str, prefix: str = ""):
+    """Yield the yyyy/, yyyy/mm/ and yyyy/mm/dd/ prefixes whose blobs all predate cutoff ('yyyy/mm/dd')"""
+    async for entry in container_client.walk_blobs(name_starts_with=prefix, delimiter="/"):
+        segment = entry.name[:-1]
+        if not isinstance(entry, BlobPrefix) or not DATE_PREFIX_RE.fullmatch(segment):
+            continue
+        
+        bound = cutoff[:len(segment)]
+        if segment < bound:
+            yield entry.name
+        elif segment == bound and len(segment) < len(cutoff):
+            # The cutoff falls inside this year or month, so split it further
+            async for stale in iter_stale_blob_prefixes(container_client, cutoff, entry.name):
+                yield stale
+
+async def iter_query_pages(container, query: str, parameters: List[Dict[str, Any]] = None, partition_key: str = None):
+    """Yield the results of a Cosmos DB query one page at a time"""
+    options = {"max_item_count": QUERY_PAGE_SIZE}
+    if partition_key is not None:
+        options["partition_key"] = partition_key
+    
+    pages = container.query_items(query=query, parameters=parameters, **options).by_page()
+    async for page in pages:
+        yield [item async for item in page]
 
 class HealthDataProcessor:
     """Main processor class for health data analysis"""
     
     def __init__(self):
         self.running = False
+        # Food and medical analyses share one limit on in-flight items
+        self.analysis_semaphore = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+        # Async clients are opened in initialize() and closed together in stop(), so
+        # their connection pools are shared by every task for the processor's lifetime
+        self.clients = AsyncExitStack()
+        self.scheduler = AsyncIOScheduler(timezone="UTC")
+        self.stopped = asyncio.Event()
+        # Prompts are built deterministically from the vision output, so repeated
+        # meals and documents resolve to the same key
+        self.completion_cache = LRUCache(COMPLETION_CACHE_SIZE)
+        # Vision output depends only on the blob content, identified by its etag
+        self.vision_cache = LRUCache(VISION_CACHE_SIZE)
+        # Batched writers for analysis results, created once the containers exist
+        self.writers = []
+        self.lock_renewer = None
         
     async def initialize(self):
-        """Initialize AI services"""
-        global openai_client, vision_client
+        """Initialize Azure and AI services"""
+        global credential, blob_service_client, cosmos_client
+        global food_container, medical_container, recommendations_container, active_users_container
+        global openai_client, vision_client, servicebus_client
         
         try:
-            # Get OpenAI API key from Key Vault
-            openai_key_secret = keyvault_client.get_secret("openai-api-key")
+            # Azure clients reuse one pool of warm TLS connections. The session is entered
+            # first so the exit stack closes it after every client using it
+            http_session = await self.clients.enter_async_context(create_http_session())
             
-            # Initialize OpenAI client
-            openai_client = AzureOpenAI(
-                azure_endpoint=AZURE_OPENAI_ENDPOINT,
-                api_key=openai_key_secret.value,
-                api_version="2024-02-01"
+            # Initialize Azure services with Managed Identity
+            credential = await self.clients.enter_async_context(
+                DefaultAzureCredential(managed_identity_client_id=AZURE_CLIENT_ID)
             )
             
-            # Initialize Vision client
-            vision_client = ImageAnalysisClient(
-                endpoint=AZURE_OPENAI_ENDPOINT,
-                credential=AzureKeyCredential(openai_key_secret.value)
-            )
+            blob_service_client = await self.clients.enter_async_context(BlobServiceClient(
+                account_url=STORAGE_ACCOUNT_ENDPOINT,
+                credential=credential,
+                max_single_get_size=BLOB_CHUNK_GET_SIZE,
+                max_chunk_get_size=BLOB_CHUNK_GET_SIZE,
+                transport=create_transport(http_session)
+            ))
+            
+            cosmos_client = await self.clients.enter_async_context(CosmosClient(
+                url=COSMOS_DB_ENDPOINT,
+                credential=credential,
+                transport=create_transport(http_session)
+            ))
+            
+            database = cosmos_client.get_database_client("HealthCompanion")
+            food_container = database.get_container_client("FoodHistory")
+            medical_container = database.get_container_client("MedicalRecords")
+            recommendations_container = database.get_container_client("Recommendations")
+            active_users_container = database.get_container_client("ActiveUsers")
+            self.food_writer = BatchWriter(food_container)
+            self.medical_writer = BatchWriter(medical_container)
+            self.writers = [self.food_writer, self.medical_writer]
+            
+            # Initialize OpenAI client with Managed Identity; the credential caches and
+            # refreshes the token, so no API key is fetched or held
+            openai_client = await self.clients.enter_async_context(AsyncAzureOpenAI(
+                azure_endpoint=AZURE_OPENAI_ENDPOINT,
+                azure_ad_token_provider=get_bearer_token_provider(
+                    credential, "https://cognitiveservices.azure.com/.default"
+                ),
+                api_version="2024-10-21",
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=HTTP_POOL_SIZE,
+                        max_keepalive_connections=ANALYSIS_CONCURRENCY
+                    )
+                )
+            ))
+            
+            # Initialize Vision client against its own endpoint, also with Managed Identity
+            vision_client = await self.clients.enter_async_context(ImageAnalysisClient(
+                endpoint=AZURE_VISION_ENDPOINT,
+                credential=credential,
+                transport=create_transport(http_session)
+            ))
+            
+            if SERVICE_BUS_CONNECTION_STRING:
+                servicebus_client = await self.clients.enter_async_context(
+                    ServiceBusClient.from_connection_string(SERVICE_BUS_CONNECTION_STRING)
+                )
+                self.lock_renewer = await self.clients.enter_async_context(
+                    AutoLockRenewer(max_lock_renewal_duration=SERVICE_BUS_LOCK_RENEWAL_SECONDS)
+                )
             
             logger.info("Background processor initialized successfully")
             
-        except Exception as e:
-            logger.error(f"Failed to initialize processor: {str(e)}")
+        except Exception:
+            logger.error("Failed to initialize processor", exc_info=True)
             raise
     
     async def start(self):
         """Start the background processor"""
         await self.initialize()
         self.running = True
-        logger.info("Background processor started")
         
-        # Start background tasks
-        tasks = [
-            asyncio.create_task(self.process_pending_analyses()),
-            asyncio.create_task(self.generate_daily_insights()),
-            asyncio.create_task(self.cleanup_old_data()),
-            asyncio.create_task(self.health_trend_analysis()),
-        ]
+        # Scheduled jobs run on the processor's event loop at fixed UTC times
+        self.scheduler.add_job(self.reconcile_active_users, CronTrigger(hour=5, minute=0))
+        self.scheduler.add_job(self.generate_daily_insights, CronTrigger(hour=6, minute=0))
+        self.scheduler.add_job(self.health_trend_analysis, CronTrigger(day_of_week="sun", hour=8, minute=0))
+        self.scheduler.add_job(self.cleanup_old_data, CronTrigger(day=1, hour=2, minute=0))
+        self.scheduler.add_job(self.sweep_pending_analyses, IntervalTrigger(hours=1))
+        self.scheduler.start()
         
-        if servicebus_client:
-            tasks.append(asyncio.create_task(self.process_service_bus_messages()))
+        logger.info("Background processor started")
         
-        await asyncio.gather(*tasks)
+        # Analysis requests arrive through Service Bus; without it only the scheduled jobs run
+        if servicebus_client:
+            await self.process_service_bus_messages()
+        else:
+            await self.stopped.wait()
     
     async def stop(self):
         """Stop the background processor"""
         self.running = False
+        self.stopped.set()
+        
+        if self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+        
+        for writer in self.writers:
+            await writer.flush()
+        
+        await self.clients.aclose()
+        
         logger.info("Background processor stopped")
     
-    async def process_pending_analyses(self):
-        """Process any pending food or medical analyses"""
-        while self.running:
-            try:
-                # Query for pending analyses
-                pending_food = list(food_container.query_items(
-                    query="SELECT * FROM c WHERE c.status = 'pending' ORDER BY c.timestamp ASC",
-                    enable_cross_partition_query=True
-                ))
-                
-                pending_medical = list(medical_container.query_items(
-                    query="SELECT * FROM c WHERE c.status = 'pending' ORDER BY c.timestamp ASC",
-                    enable_cross_partition_query=True
-                ))
-                
-                # Process pending food analyses
-                for item in pending_food:
-                    await self.process_food_analysis(item)
-                
-                # Process pending medical analyses
-                for item in pending_medical:
-                    await self.process_medical_analysis(item)
-                
-                # Wait before next check
-                await asyncio.sleep(60)  # Check every minute
-                
-            except Exception as e:
-                logger.error(f"Error in process_pending_analyses: {str(e)}")
-                await asyncio.sleep(60)
-    
-    async def process_food_analysis(self, item: Dict[str, Any]):
-        """Process a single food analysis item"""
+    async def sweep_pending_analyses(self):
+        """Pick up pending analyses whose Service Bus request was lost (scheduled hourly)"""
         try:
-            # Download image from blob storage
-            blob_client = blob_service_client.get_blob_client(
-                container="food-images",
-                blob=item.get('imagePath', '')
-            )
-            
-            image_data = blob_client.download_blob().readall()
+            parameters = [{"name": "@cutoff", "value": (datetime.utcnow() - PENDING_SWEEP_WINDOW).isoformat()}]
             
-            # Analyze with Vision API
-            vision_result = vision_client.analyze(
-                image_data=image_data,
-                visual_features=[VisualFeatures.OBJECTS, VisualFeatures.TAGS, VisualFeatures.CAPTION]
+            # Process pending food and medical analyses side by side
+            await asyncio.gather(
+                self.process_pending_items(food_container, PENDING_FOOD_QUERY, parameters, self.process_food_analysis),
+                self.process_pending_items(medical_container, PENDING_MEDICAL_QUERY, parameters, self.process_medical_analysis)
             )
             
-            # Generate nutritional analysis with OpenAI
-            analysis_prompt = f"""
-            Analyze this food image and provide detailed nutritional information:
-            
-            Vision analysis:
-            Caption: {vision_result.caption.text if vision_result.caption else 'N/A'}
-            Objects: {[obj.tags[0].name for obj in vision_result.objects] if vision_result.objects else []}
-            Tags: {[tag.name for tag in vision_result.tags[:10]] if vision_result.tags else []}
-            
-            Provide comprehensive analysis including:
-            1. Detailed food identification
-            2. Nutritional breakdown (calories, macros, micros)
-            3. Health assessment
-            4. Personalized recommendations
-            
-            Format as JSON with keys: food_items, nutrition_info, health_assessment, recommendations
-            """
+        except Exception:
+            logger.error("Error in sweep_pending_analyses", exc_info=True)
+    
+    async def process_pending_items(self, container, query: str, parameters: List[Dict[str, Any]], handler):
+        """Run handler on every item returned by query, processing each page concurrently"""
+        async for page in iter_query_pages(container, query, parameters):
+            await asyncio.gather(
+                *(self.run_limited(handler, item) for item in page),
+                return_exceptions=True
+            )
+    
+    async def run_limited(self, handler, item: Dict[str, Any], **options):
+        """Run an analysis handler while holding a slot of the shared concurrency limit"""
+        async with self.analysis_semaphore:
+            await handler(item, **options)
+    
+    async def analyze_blob(self, container: str, blob_name: str, features: List[VisualFeatures], extract, prepare=None):
+        """Run Vision over a blob and return extract(result), reusing the result while the blob is unchanged.
+        
+        prepare, if given, transforms the downloaded bytes before they are sent and runs in a worker thread.
+        """
+        blob_client = blob_service_client.get_blob_client(container=container, blob=blob_name)
+        properties = await blob_client.get_blob_properties()
+        key = f"vision:{container}/{blob_name}:{properties.etag}:{','.join(feature.value for feature in features)}"
+        
+        extracted = self.vision_cache.get(key)
+        if extracted is None:
+            # Pin the download to the etag the key was built from
+            stream = await blob_client.download_blob(
+                max_concurrency=BLOB_DOWNLOAD_CONCURRENCY,
+                etag=properties.etag,
+                match_condition=MatchConditions.IfNotModified
+            )
+            data = await stream.readall()
+            if prepare is not None:
+                data = await asyncio.to_thread(prepare, data)
             
-            response = openai_client.chat.completions.create(
+            vision_result = await vision_client.analyze(image_data=data, visual_features=features)
+            extracted = extract(vision_result)
+            self.vision_cache.put(key, extracted)
+        
+        return extracted
+    
+    async def complete_json(self, namespace: str, system_prompt: str, prompt: str, temperature: float) -> Dict[str, Any]:
+        """Return GPT-4's JSON reply to a prompt, reusing the reply to an identical earlier prompt"""
+        digest = hashlib.sha256(f"{system_prompt}\n{prompt}".encode()).hexdigest()
+        key = f"{namespace}:{digest}"
+        content = self.completion_cache.get(key)
+        if content is None:
+            response = await openai_client.chat.completions.create(
                 model="gpt-4",
                 messages=[
-                    {"role": "system", "content": "You are an expert nutritionist and health analyst."},
-                    {"role": "user", "content": analysis_prompt}
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt}
                 ],
-                temperature=0.2
+                temperature=temperature,
+                # JSON mode: the reply is always a parseable JSON object
+                response_format={"type": "json_object"}
             )
+            content = response.choices[0].message.content
+            result = json.loads(content)
+            self.completion_cache.put(key, content)
+            return result
+        
+        return json.loads(content)
+    
+    async def process_food_analysis(self, item: Dict[str, Any], raise_transient: bool = False):
+        """Process a single food analysis item"""
+        try:
+            # Analyze the image with Vision API
+            vision = await self.analyze_blob(
+                "food-images",
+                item.get('imagePath', ''),
+                [VisualFeatures.OBJECTS, VisualFeatures.TAGS, VisualFeatures.CAPTION],
+                extract_food_features,
+                prepare=downscale_image
+            )
+            
+            # Generate nutritional analysis with OpenAI
+            analysis_prompt = FOOD_ANALYSIS_PROMPT.format_map(vision)
             
-            # Parse and update the item
-            analysis_result = json.loads(response.choices[0].message.content)
+            analysis_result = await self.complete_json(
+                "food",
+                FOOD_ANALYSIS_SYSTEM_PROMPT,
+                analysis_prompt,
+                temperature=0.2
+            )
             
-            # Update item with analysis results
-            item.update({
+            # Update the stored item with the analysis results
+            await self.food_writer.patch(item, {
                 'status': 'completed',
                 'foodItems': analysis_result.get('food_items', []),
                 'nutritionInfo': analysis_result.get('nutrition_info', {}),
@@ -230,77 +761,48 @@ class HealthDataProcessor:
                 'processedAt': datetime.utcnow().isoformat()
             })
             
-            # Update in Cosmos DB
-            food_container.upsert_item(item)
-            
-            logger.info(f"Processed food analysis for item {item['id']}")
+            logger.info("Processed food analysis for item %s", item['id'], extra=item_dimensions(item))
             
         except Exception as e:
-            logger.error(f"Error processing food analysis {item.get('id', 'unknown')}: {str(e)}")
+            logger.error("Error processing food analysis %s", item.get('id', 'unknown'), extra=item_dimensions(item), exc_info=True)
+            
+            # Leave the item pending so the redelivered message (or the sweep) retries it
+            if raise_transient and is_transient_error(e):
+                raise
             
             # Mark as failed
-            item.update({
+            await self.food_writer.patch(item, {
                 'status': 'failed',
                 'error': str(e),
                 'processedAt': datetime.utcnow().isoformat()
             })
-            food_container.upsert_item(item)
     
-    async def process_medical_analysis(self, item: Dict[str, Any]):
+    async def process_medical_analysis(self, item: Dict[str, Any], raise_transient: bool = False):
         """Process a single medical document analysis"""
         try:
-            # Download document from blob storage
-            blob_client = blob_service_client.get_blob_client(
-                container="medical-documents",
-                blob=item.get('documentPath', '')
-            )
-            
-            document_data = blob_client.download_blob().readall()
-            
             # Extract text with Vision API (OCR)
-            vision_result = vision_client.analyze(
-                image_data=document_data,
-                visual_features=[VisualFeatures.READ]
+            extracted_text = await self.analyze_blob(
+                "medical-documents",
+                item.get('documentPath', ''),
+                [VisualFeatures.READ],
+                extract_document_text
             )
             
-            extracted_text = ""
-            if vision_result.read:
-                for page in vision_result.read.blocks:
-                    for line in page.lines:
-                        extracted_text += line.text + "\n"
-            
             # Analyze medical content with OpenAI
-            analysis_prompt = f"""
-            Analyze this medical document and provide comprehensive medical insights:
-            
-            Document Type: {item.get('documentType', 'general')}
-            Extracted Text:
-            {extracted_text}
-            
-            Provide detailed analysis including:
-            1. Key medical findings and abnormalities
-            2. Important metrics and values
-            3. Risk assessment
-            4. Recommended follow-up actions
-            5. Lifestyle recommendations
-            
-            Format as JSON with keys: key_findings, metrics, risk_assessment, follow_up_actions, lifestyle_recommendations
-            """
+            analysis_prompt = MEDICAL_ANALYSIS_PROMPT.format_map({
+                "document_type": item.get('documentType', 'general'),
+                "extracted_text": extracted_text
+            })
             
-            response = openai_client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a medical AI assistant. Provide analysis for informational purposes only."},
-                    {"role": "user", "content": analysis_prompt}
-                ],
+            analysis_result = await self.complete_json(
+                "medical",
+                MEDICAL_ANALYSIS_SYSTEM_PROMPT,
+                analysis_prompt,
                 temperature=0.1
             )
             
-            # Parse and update the item
-            analysis_result = json.loads(response.choices[0].message.content)
-            
-            # Update item with analysis results
-            item.update({
+            # Update the stored item with the analysis results
+            await self.medical_writer.patch(item, {
                 'status': 'completed',
                 'extractedText': extracted_text,
                 'keyFindings': analysis_result.get('key_findings', []),
@@ -311,133 +813,143 @@ class HealthDataProcessor:
                 'processedAt': datetime.utcnow().isoformat()
             })
             
-            # Update in Cosmos DB
-            medical_container.upsert_item(item)
-            
-            logger.info(f"Processed medical analysis for item {item['id']}")
+            logger.info("Processed medical analysis for item %s", item['id'], extra=item_dimensions(item))
             
         except Exception as e:
-            logger.error(f"Error processing medical analysis {item.get('id', 'unknown')}: {str(e)}")
+            logger.error("Error processing medical analysis %s", item.get('id', 'unknown'), extra=item_dimensions(item), exc_info=True)
+            
+            # Leave the item pending so the redelivered message (or the sweep) retries it
+            if raise_transient and is_transient_error(e):
+                raise
             
             # Mark as failed
-            item.update({
+            await self.medical_writer.patch(item, {
                 'status': 'failed',
                 'error': str(e),
                 'processedAt': datetime.utcnow().isoformat()
             })
-            medical_container.upsert_item(item)
     
-    async def generate_daily_insights(self):
-        """Generate daily health insights for all users"""
-        while self.running:
-            try:
-                current_time = datetime.utcnow()
-                
-                # Run daily at 6 AM UTC
-                if current_time.hour == 6 and current_time.minute == 0:
-                    logger.info("Starting daily insights generation")
-                    
-                    # Get unique users from the last 30 days
-                    cutoff_date = (current_time - timedelta(days=30)).isoformat()
-                    
-                    users_query = """
-                    SELECT DISTINCT c.userId FROM c 
-                    WHERE c.timestamp >= @cutoff_date
-                    """
-                    
-                    users = set()
-                    
-                    # Get users from food history
-                    for item in food_container.query_items(
-                        query=users_query,
-                        parameters=[{"name": "@cutoff_date", "value": cutoff_date}],
-                        enable_cross_partition_query=True
-                    ):
-                        users.add(item['userId'])
-                    
-                    # Get users from medical history
-                    for item in medical_container.query_items(
-                        query=users_query,
-                        parameters=[{"name": "@cutoff_date", "value": cutoff_date}],
-                        enable_cross_partition_query=True
-                    ):
-                        users.add(item['userId'])
-                    
-                    # Generate insights for each user
-                    for user_id in users:
-                        await self.generate_user_daily_insights(user_id)
-                    
-                    logger.info(f"Daily insights generated for {len(users)} users")
-                
-                # Check every minute
-                await asyncio.sleep(60)
-                
-            except Exception as e:
-                logger.error(f"Error in generate_daily_insights: {str(e)}")
-                await asyncio.sleep(60)
+    async def get_active_users(self) -> set:
+        """Return the IDs of users with an upload in the last 30 days"""
+        active_users = set()
+        async for user in active_users_container.read_all_items(max_item_count=QUERY_PAGE_SIZE):
+            active_users.add(user['id'])
+        return active_users
     
-    async def generate_user_daily_insights(self, user_id: str):
-        """Generate daily insights for a specific user"""
+    async def reconcile_active_users(self):
+        """Backfill ActiveUsers from the history containers (scheduled daily at 5 AM UTC)"""
         try:
-            # Get user's recent data
-            recent_cutoff = (datetime.utcnow() - timedelta(days=7)).isoformat()
+            # The API marks users active on upload; this catches writes that failed
+            # and data that predates the ActiveUsers container
+            cutoff = datetime.utcnow() - timedelta(days=30)
+            known_users = await self.get_active_users()
+            added = 0
             
-            # Get recent food history
-            recent_food = list(food_container.query_items(
-                query="SELECT * FROM c WHERE c.userId = @userId AND c.timestamp >= @cutoff ORDER BY c.timestamp DESC",
-                parameters=[
-                    {"name": "@userId", "value": user_id},
-                    {"name": "@cutoff", "value": recent_cutoff}
-                ],
-                enable_cross_partition_query=True
-            ))
-            
-            # Get recent medical data
-            recent_medical = list(medical_container.query_items(
-                query="SELECT * FROM c WHERE c.userId = @userId AND c.timestamp >= @cutoff ORDER BY c.timestamp DESC",
-                parameters=[
-                    {"name": "@userId", "value": user_id},
-                    {"name": "@cutoff", "value": recent_cutoff}
-                ],
-                enable_cross_partition_query=True
-            ))
+            for container in [food_container, medical_container]:
+                async for page in iter_query_pages(
+                    container,
+                    "SELECT DISTINCT c.userId FROM c WHERE c.timestamp >= @cutoff",
+                    [{"name": "@cutoff", "value": cutoff.isoformat()}]
+                ):
+                    for row in page:
+                        if row['userId'] in known_users:
+                            continue
+                        
+                        await active_users_container.upsert_item({
+                            'id': row['userId'],
+                            'userId': row['userId'],
+                            'lastSeen': datetime.utcnow().isoformat(),
+                            'ttl': ACTIVE_USER_TTL_SECONDS
+                        })
+                        known_users.add(row['userId'])
+                        added += 1
             
-            if not recent_food and not recent_medical:
-                return  # No recent data for this user
+            logger.info("Active users reconciled, %d users added", added)
             
-            # Generate comprehensive insights
-            insights_prompt = f"""
-            Generate comprehensive daily health insights for this user based on their recent activity:
-            
-            Recent Food History (last 7 days):
-            {json.dumps(recent_food[:10], indent=2)}
+        except Exception:
+            logger.error("Error in reconcile_active_users", exc_info=True)
+    
+    async def generate_daily_insights(self):
+        """Generate daily health insights for all users (scheduled daily at 6 AM UTC)"""
+        try:
+            logger.info("Starting daily insights generation")
             
-            Recent Medical Data (last 7 days):
-            {json.dumps(recent_medical[:5], indent=2)}
+            # Users with an upload in the last 30 days
+            users = await self.get_active_users()
+            recent_cutoff = (datetime.utcnow() - timedelta(days=7)).isoformat()
             
-            Provide insights including:
-            1. Nutritional trends and patterns
-            2. Health improvements or concerns
-            3. Personalized recommendations for today
-            4. Long-term health goals suggestions
-            5. Risk factors and preventive measures
+            # Build one request per user, then run them all as a single batch job
+            requests = {}
+            for user_id in users:
+                try:
+                    body = await self.build_daily_insights_request(user_id, recent_cutoff)
+                except Exception:
+                    logger.error("Error preparing daily insights for user %s", user_id, extra=user_dimensions(user_id), exc_info=True)
+                    continue
+                if body is not None:
+                    requests[user_id] = body
             
-            Format as JSON with keys: nutritional_trends, health_status, daily_recommendations, long_term_goals, risk_factors
-            """
+            results = await self.run_chat_batch(requests)
             
-            response = openai_client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a comprehensive health AI analyst providing personalized insights."},
-                    {"role": "user", "content": insights_prompt}
-                ],
-                temperature=0.3
-            )
+            for user_id, daily_insights in results.items():
+                await self.save_daily_insights(user_id, daily_insights, recent_cutoff)
             
-            # Parse insights
-            daily_insights = json.loads(response.choices[0].message.content)
+            logger.info("Daily insights generated for %d of %d users", len(results), len(requests))
             
-            # Save insights
+        except Exception:
+            logger.error("Error in generate_daily_insights", exc_info=True)
+    
+    async def build_daily_insights_request(self, user_id: str, recent_cutoff: str):
+        """Build the chat completion request for a user's daily insights, or None without recent data"""
+        parameters = [
+            {"name": "@userId", "value": user_id},
+            {"name": "@cutoff", "value": recent_cutoff}
+        ]
+        
+        # Get recent food history (only the first page is needed for the prompt)
+        recent_food = []
+        async for page in iter_query_pages(
+            food_container,
+            RECENT_FOOD_QUERY,
+            parameters,
+            partition_key=user_id
+        ):
+            recent_food = page
+            break
+        
+        # Get recent medical data
+        recent_medical = []
+        async for page in iter_query_pages(
+            medical_container,
+            RECENT_MEDICAL_QUERY,
+            parameters,
+            partition_key=user_id
+        ):
+            recent_medical = page
+            break
+        
+        if not recent_food and not recent_medical:
+            return None  # No recent data for this user
+        
+        # Generate comprehensive insights
+        insights_prompt = DAILY_INSIGHTS_PROMPT.format_map({
+            "food_history": json.dumps(recent_food[:10], indent=2),
+            "medical_history": json.dumps(recent_medical[:5], indent=2)
+        })
+        
+        return {
+            "model": AZURE_OPENAI_BATCH_DEPLOYMENT,
+            "messages": [
+                {"role": "system", "content": DAILY_INSIGHTS_SYSTEM_PROMPT},
+                {"role": "user", "content": insights_prompt}
+            ],
+            "temperature": 0.3,
+            "response_format": {"type": "json_object"}
+        }
+    
+    async def save_daily_insights(self, user_id: str, daily_insights: Dict[str, Any], recent_cutoff: str):
+        """Save the daily insights generated for a user"""
+        try:
             insight_record = {
                 "id": f"{user_id}-insights-{datetime.utcnow().date().isoformat()}",
                 "userId": user_id,
@@ -454,112 +966,98 @@ class HealthDataProcessor:
                 }
             }
             
-            recommendations_container.upsert_item(insight_record)
+            await recommendations_container.upsert_item(insight_record)
             
-            logger.info(f"Generated daily insights for user {user_id}")
+            logger.info("Generated daily insights for user %s", user_id, extra=user_dimensions(user_id))
             
-        except Exception as e:
-            logger.error(f"Error generating daily insights for user {user_id}: {str(e)}")
+        except Exception:
+            logger.error("Error saving daily insights for user %s", user_id, extra=user_dimensions(user_id), exc_info=True)
     
     async def health_trend_analysis(self):
-        """Analyze long-term health trends for users"""
-        while self.running:
-            try:
-                # Run weekly trend analysis
-                current_time = datetime.utcnow()
-                
-                if current_time.weekday() == 6 and current_time.hour == 8:  # Sunday at 8 AM UTC
-                    logger.info("Starting weekly health trend analysis")
-                    
-                    # Get users who have been active in the last 30 days
-                    cutoff_date = (current_time - timedelta(days=30)).isoformat()
-                    
-                    active_users = set()
-                    
-                    # Get active users
-                    for container in [food_container, medical_container]:
-                        for item in container.query_items(
-                            query="SELECT DISTINCT c.userId FROM c WHERE c.timestamp >= @cutoff",
-                            parameters=[{"name": "@cutoff", "value": cutoff_date}],
-                            enable_cross_partition_query=True
-                        ):
-                            active_users.add(item['userId'])
-                    
-                    # Analyze trends for each user
-                    for user_id in active_users:
-                        await self.analyze_user_health_trends(user_id)
-                    
-                    logger.info(f"Health trend analysis completed for {len(active_users)} users")
-                
-                await asyncio.sleep(3600)  # Check every hour
-                
-            except Exception as e:
-                logger.error(f"Error in health_trend_analysis: {str(e)}")
-                await asyncio.sleep(3600)
-    
-    async def analyze_user_health_trends(self, user_id: str):
-        """Analyze health trends for a specific user"""
+        """Analyze long-term health trends for users (scheduled weekly, Sunday at 8 AM UTC)"""
         try:
-            # Get user's data from the last 90 days
-            trend_cutoff = (datetime.utcnow() - timedelta(days=90)).isoformat()
-            
-            # Get historical food data
-            food_history = list(food_container.query_items(
-                query="SELECT * FROM c WHERE c.userId = @userId AND c.timestamp >= @cutoff ORDER BY c.timestamp ASC",
-                parameters=[
-                    {"name": "@userId", "value": user_id},
-                    {"name": "@cutoff", "value": trend_cutoff}
-                ],
-                enable_cross_partition_query=True
-            ))
-            
-            # Get historical medical data
-            medical_history = list(medical_container.query_items(
-                query="SELECT * FROM c WHERE c.userId = @userId AND c.timestamp >= @cutoff ORDER BY c.timestamp ASC",
-                parameters=[
-                    {"name": "@userId", "value": user_id},
-                    {"name": "@cutoff", "value": trend_cutoff}
-                ],
-                enable_cross_partition_query=True
-            ))
-            
-            if len(food_history) < 5:  # Need minimum data for trend analysis
-                return
-            
-            # Generate trend analysis
-            trend_prompt = f"""
-            Analyze long-term health trends for this user over the last 90 days:
+            logger.info("Starting weekly health trend analysis")
             
-            Food History Trend:
-            {json.dumps(food_history, indent=2)}
-            
-            Medical History Trend:
-            {json.dumps(medical_history, indent=2)}
+            # Get users who have been active in the last 30 days
+            active_users = await self.get_active_users()
+            trend_cutoff = (datetime.utcnow() - timedelta(days=90)).isoformat()
             
-            Provide comprehensive trend analysis including:
-            1. Nutritional pattern changes over time
-            2. Health metric improvements or deteriorations
-            3. Behavioral pattern identification
-            4. Risk trend assessment
-            5. Long-term health trajectory prediction
-            6. Personalized intervention recommendations
+            # Build one request per user with enough history, then run them as a single batch job
+            requests = {}
+            data_points = {}
+            for user_id in active_users:
+                try:
+                    prepared = await self.build_health_trends_request(user_id, trend_cutoff)
+                except Exception:
+                    logger.error("Error preparing health trends for user %s", user_id, extra=user_dimensions(user_id), exc_info=True)
+                    continue
+                if prepared is not None:
+                    requests[user_id], data_points[user_id] = prepared
             
-            Format as JSON with keys: nutritional_patterns, health_metrics_trend, behavioral_patterns, risk_trends, health_trajectory, interventions
-            """
+            results = await self.run_chat_batch(requests)
             
-            response = openai_client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are an expert health trend analyst providing longitudinal health assessments."},
-                    {"role": "user", "content": trend_prompt}
-                ],
-                temperature=0.2
-            )
+            for user_id, trend_analysis in results.items():
+                await self.save_health_trends(user_id, trend_analysis, trend_cutoff, data_points[user_id])
             
-            # Parse trend analysis
-            trend_analysis = json.loads(response.choices[0].message.content)
+            logger.info("Health trend analysis completed for %d of %d users", len(results), len(requests))
             
-            # Save trend analysis
+        except Exception:
+            logger.error("Error in health_trend_analysis", exc_info=True)
+    
+    async def build_health_trends_request(self, user_id: str, trend_cutoff: str):
+        """Build the chat completion request for a user's trend analysis and count the items it covers.
+        
+        Returns None when the user has too little food history for a trend analysis.
+        """
+        parameters = [
+            {"name": "@userId", "value": user_id},
+            {"name": "@cutoff", "value": trend_cutoff}
+        ]
+        
+        # Stream the history into bounded summaries rather than holding every item
+        food_trends = TrendAgg('nutritionInfo', compact_food_item)
+        async for page in iter_query_pages(
+            food_container,
+            TREND_FOOD_QUERY,
+            parameters,
+            partition_key=user_id
+        ):
+            for item in page:
+                food_trends.update(item)
+        
+        if food_trends.count < 5:  # Need minimum data for trend analysis
+            return None
+        
+        medical_trends = TrendAgg('metrics', compact_medical_item)
+        async for page in iter_query_pages(
+            medical_container,
+            TREND_MEDICAL_QUERY,
+            parameters,
+            partition_key=user_id
+        ):
+            for item in page:
+                medical_trends.update(item)
+        
+        # Generate trend analysis
+        trend_prompt = HEALTH_TRENDS_PROMPT.format_map({
+            "food_summary": json.dumps(food_trends.to_summary_dict()),
+            "medical_summary": json.dumps(medical_trends.to_summary_dict())
+        })
+        
+        body = {
+            "model": AZURE_OPENAI_BATCH_DEPLOYMENT,
+            "messages": [
+                {"role": "system", "content": HEALTH_TRENDS_SYSTEM_PROMPT},
+                {"role": "user", "content": trend_prompt}
+            ],
+            "temperature": 0.2,
+            "response_format": {"type": "json_object"}
+        }
+        return body, food_trends.count + medical_trends.count
+    
+    async def save_health_trends(self, user_id: str, trend_analysis: Dict[str, Any], trend_cutoff: str, data_points: int):
+        """Save the trend analysis generated for a user"""
+        try:
             trend_record = {
                 "id": f"{user_id}-trends-{datetime.utcnow().date().isoformat()}",
                 "userId": user_id,
@@ -574,61 +1072,98 @@ class HealthDataProcessor:
                 "analysisRange": {
                     "start": trend_cutoff,
                     "end": datetime.utcnow().isoformat(),
-                    "dataPoints": len(food_history) + len(medical_history)
+                    "dataPoints": data_points
                 }
             }
             
-            recommendations_container.upsert_item(trend_record)
+            await recommendations_container.upsert_item(trend_record)
             
-            logger.info(f"Generated health trend analysis for user {user_id}")
+            logger.info("Generated health trend analysis for user %s", user_id, extra=user_dimensions(user_id))
             
-        except Exception as e:
-            logger.error(f"Error analyzing health trends for user {user_id}: {str(e)}")
+        except Exception:
+            logger.error("Error saving health trends for user %s", user_id, extra=user_dimensions(user_id), exc_info=True)
     
-    async def cleanup_old_data(self):
-        """Clean up old data to manage storage costs"""
-        while self.running:
+    async def run_chat_batch(self, requests: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Run chat completions as an OpenAI batch job and return each parsed JSON reply by request ID"""
+        if not requests:
+            return {}
+        
+        lines = "\n".join(
+            json.dumps({"custom_id": custom_id, "method": "POST", "url": "/chat/completions", "body": body})
+            for custom_id, body in requests.items()
+        )
+        batch_file = await openai_client.files.create(file=("requests.jsonl", lines.encode()), purpose="batch")
+        batch = await openai_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/chat/completions",
+            completion_window="24h"
+        )
+        
+        # Batch jobs take minutes to hours; nothing else waits on these results
+        while batch.status not in BATCH_TERMINAL_STATUSES:
+            await asyncio.sleep(BATCH_POLL_INTERVAL_SECONDS)
+            batch = await openai_client.batches.retrieve(batch.id)
+        
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+        
+        output = await openai_client.files.content(batch.output_file_id)
+        
+        results = {}
+        for line in output.text.splitlines():
+            result = json.loads(line)
+            response = result.get("response") or {}
             try:
-                # Run cleanup monthly
-                current_time = datetime.utcnow()
-                
-                if current_time.day == 1 and current_time.hour == 2:  # First day of month at 2 AM UTC
-                    logger.info("Starting monthly data cleanup")
-                    
-                    # Delete data older than 2 years
-                    cleanup_cutoff = (current_time - timedelta(days=730)).isoformat()
-                    
-                    # Cleanup old food history (keep aggregated summaries)
-                    old_food_items = list(food_container.query_items(
-                        query="SELECT c.id, c.userId FROM c WHERE c.timestamp < @cutoff",
-                        parameters=[{"name": "@cutoff", "value": cleanup_cutoff}],
-                        enable_cross_partition_query=True
-                    ))
-                    
-                    for item in old_food_items:
-                        food_container.delete_item(item=item['id'], partition_key=item['userId'])
-                    
-                    # Cleanup old medical records (be more conservative)
-                    old_medical_cutoff = (current_time - timedelta(days=1095)).isoformat()  # 3 years
-                    old_medical_items = list(medical_container.query_items(
-                        query="SELECT c.id, c.userId FROM c WHERE c.timestamp < @cutoff AND c.type != 'critical'",
-                        parameters=[{"name": "@cutoff", "value": old_medical_cutoff}],
-                        enable_cross_partition_query=True
-                    ))
-                    
-                    for item in old_medical_items:
-                        medical_container.delete_item(item=item['id'], partition_key=item['userId'])
-                    
-                    # Cleanup old blob storage files
-                    await self.cleanup_old_blobs(cleanup_cutoff)
-                    
-                    logger.info(f"Cleanup completed: removed {len(old_food_items)} food items and {len(old_medical_items)} medical items")
-                
-                await asyncio.sleep(3600)  # Check every hour
+                if response.get("status_code") != 200:
+                    raise ValueError(f"status {response.get('status_code')}")
+                results[result["custom_id"]] = json.loads(response["body"]["choices"][0]["message"]["content"])
+            except (KeyError, IndexError, ValueError) as e:
+                logger.error(
+                    "Batch %s request %s failed: %s", batch.id, result.get('custom_id'), e,
+                    extra={"custom_dimensions": {"batchId": batch.id, "userId": result.get('custom_id')}}
+                )
+        
+        return results
+    
+    async def cleanup_old_data(self):
+        """Clean up old data to manage storage costs (scheduled monthly, 1st at 2 AM UTC)"""
+        try:
+            current_time = datetime.utcnow()
+            
+            logger.info("Starting monthly data cleanup")
+            
+            # Delete data older than 2 years. Food history expires on its own through
+            # the container's default TTL, so only the blobs need removing here
+            cleanup_cutoff = (current_time - timedelta(days=730)).isoformat()
+            
+            # Cleanup old medical records (be more conservative)
+            old_medical_cutoff = (current_time - timedelta(days=1095)).isoformat()  # 3 years
+            old_medical_count = 0
+            async for page in iter_query_pages(
+                medical_container,
+                "SELECT c.id, c.userId FROM c WHERE c.timestamp < @cutoff AND c.type != 'critical'",
+                [{"name": "@cutoff", "value": old_medical_cutoff}]
+            ):
+                # One transactional batch per partition instead of a round trip per item;
+                # a page never exceeds the 100-operation batch limit
+                ids_by_user = {}
+                for item in page:
+                    ids_by_user.setdefault(item['userId'], []).append(item['id'])
                 
-            except Exception as e:
-                logger.error(f"Error in cleanup_old_data: {str(e)}")
-                await asyncio.sleep(3600)
+                for user_id, ids in ids_by_user.items():
+                    await medical_container.execute_item_batch(
+                        [("delete", (item_id,)) for item_id in ids],
+                        partition_key=user_id
+                    )
+                old_medical_count += len(page)
+            
+            # Cleanup old blob storage files
+            await self.cleanup_old_blobs(cleanup_cutoff)
+            
+            logger.info("Cleanup completed: removed %d medical items", old_medical_count)
+            
+        except Exception:
+            logger.error("Error in cleanup_old_data", exc_info=True)
     
     async def cleanup_old_blobs(self, cutoff_date: str):
         """Clean up old blob storage files"""
@@ -637,21 +1172,49 @@ class HealthDataProcessor:
             
             for container_name in ['food-images', 'medical-documents']:
                 container_client = blob_service_client.get_container_client(container_name)
+                deleted = 0
                 
-                blobs_to_delete = []
-                for blob in container_client.list_blobs():
-                    if blob.last_modified < cutoff_datetime:
-                        blobs_to_delete.append(blob.name)
+                # Whole days before the cutoff are listed by prefix, without touching newer blobs
+                async for prefix in iter_stale_blob_prefixes(container_client, f"{cutoff_datetime:%Y/%m/%d}"):
+                    deleted += await self.delete_blobs_under(container_client, prefix)
                 
-                # Delete old blobs
-                for blob_name in blobs_to_delete:
-                    blob_client = container_client.get_blob_client(blob_name)
-                    blob_client.delete_blob()
+                # Blobs uploaded before date prefixes still need their modification time checked
+                deleted += await self.delete_blobs_under(
+                    container_client,
+                    LEGACY_BLOB_PREFIXES[container_name],
+                    lambda blob: blob.last_modified.replace(tzinfo=None) < cutoff_datetime.replace(tzinfo=None)
+                )
                 
-                logger.info(f"Deleted {len(blobs_to_delete)} old blobs from {container_name}")
+                logger.info("Deleted %d old blobs from %s", deleted, container_name, extra={"custom_dimensions": {"container": container_name}})
                 
-        except Exception as e:
-            logger.error(f"Error cleaning up old blobs: {str(e)}")
+        except Exception:
+            logger.error("Error cleaning up old blobs", exc_info=True)
+    
+    async def delete_blobs_under(self, container_client, prefix: str, is_stale=None) -> int:
+        """Delete the blobs under a prefix in Blob Batch requests, returning how many were deleted"""
+        deleted = 0
+        batch = []
+        async for blob in container_client.list_blobs(name_starts_with=prefix):
+            if is_stale is not None and not is_stale(blob):
+                continue
+            
+            batch.append(blob.name)
+            if len(batch) == BLOB_DELETE_BATCH_SIZE:
+                deleted += await self.delete_blob_batch(container_client, batch)
+                batch = []
+        
+        if batch:
+            deleted += await self.delete_blob_batch(container_client, batch)
+        return deleted
+    
+    async def delete_blob_batch(self, container_client, blob_names: List[str]) -> int:
+        """Delete up to BLOB_DELETE_BATCH_SIZE blobs in one request"""
+        responses = await container_client.delete_blobs(*blob_names, raise_on_any_failure=False)
+        deleted = 0
+        async for response in responses:
+            if response.status_code == 202:
+                deleted += 1
+        return deleted
     
     async def process_service_bus_messages(self):
         """Process messages from Service Bus for real-time notifications"""
@@ -660,55 +1223,71 @@ class HealthDataProcessor:
         
         while self.running:
             try:
-                with servicebus_client.get_queue_receiver(queue_name="health-notifications") as receiver:
-                    for msg in receiver:
-                        try:
-                            message_data = json.loads(str(msg))
-                            await self.handle_notification_message(message_data)
-                            receiver.complete_message(msg)
-                            
-                        except Exception as e:
-                            logger.error(f"Error processing Service Bus message: {str(e)}")
-                            receiver.abandon_message(msg)
-                
-                await asyncio.sleep(10)  # Check every 10 seconds
+                async with servicebus_client.get_queue_receiver(
+                    queue_name=SERVICE_BUS_QUEUE_NAME,
+                    prefetch_count=SERVICE_BUS_BATCH_SIZE,
+                    auto_lock_renewer=self.lock_renewer
+                ) as receiver:
+                    while self.running:
+                        messages = await receiver.receive_messages(
+                            max_message_count=SERVICE_BUS_BATCH_SIZE,
+                            max_wait_time=SERVICE_BUS_MAX_WAIT_SECONDS
+                        )
+                        # Analysis requests take a slot of the shared semaphore in run_limited
+                        await asyncio.gather(
+                            *(self.handle_service_bus_message(receiver, msg) for msg in messages),
+                            return_exceptions=True
+                        )
                 
-            except Exception as e:
-                logger.error(f"Error in process_service_bus_messages: {str(e)}")
+            except Exception:
+                logger.error("Error in process_service_bus_messages", exc_info=True)
                 await asyncio.sleep(30)
     
-    async def handle_notification_message(self, message_data: Dict[str, Any]):
-        """Handle notification messages"""
+    async def handle_service_bus_message(self, receiver, msg):
+        """Handle one received message and settle it on the receiver"""
         try:
-            message_type = message_data.get('type')
-            user_id = message_data.get('userId')
-            
-            if message_type == 'urgent_health_alert':
-                await self.process_urgent_health_alert(user_id, message_data)
-            elif message_type == 'daily_reminder':
-                await self.process_daily_reminder(user_id, message_data)
-            elif message_type == 'analysis_request':
-                await self.process_analysis_request(user_id, message_data)
+            message_data = json.loads(str(msg))
+            await self.handle_notification_message(message_data)
+            await receiver.complete_message(msg)
             
-            logger.info(f"Processed notification message type: {message_type} for user: {user_id}")
-            
-        except Exception as e:
-            logger.error(f"Error handling notification message: {str(e)}")
+        except Exception:
+            logger.error("Error processing Service Bus message %s", msg.message_id, extra={"custom_dimensions": {"messageId": msg.message_id}}, exc_info=True)
+            await receiver.abandon_message(msg)
     
-    async def process_urgent_health_alert(self, user_id: str, message_data: Dict[str, Any]):
-        """Process urgent health alerts"""
-        # Implement urgent health alert processing
-        pass
-    
-    async def process_daily_reminder(self, user_id: str, message_data: Dict[str, Any]):
-        """Process daily reminder messages"""
-        # Implement daily reminder processing
-        pass
+    async def handle_notification_message(self, message_data: Dict[str, Any]):
+        """Handle notification messages.
+        
+        Errors propagate so the caller abandons the message and Service Bus redelivers
+        or dead-letters it.
+        """
+        message_type = message_data.get('type')
+        user_id = message_data.get('userId')
+        
+        if message_type in UNIMPLEMENTED_MESSAGE_TYPES:
+            logger.debug("Skipping unhandled notification message type: %s", message_type)
+            return
+        
+        if message_type == 'analysis_request':
+            await self.process_analysis_request(user_id, message_data)
+        
+        logger.info(
+            "Processed notification message type: %s for user: %s", message_type, user_id,
+            extra={"custom_dimensions": {"messageType": message_type, "userId": user_id}}
+        )
     
     async def process_analysis_request(self, user_id: str, message_data: Dict[str, Any]):
-        """Process analysis request messages"""
-        # Implement analysis request processing
-        pass
+        """Process analysis request messages sent when a new food or medical item is submitted.
+        
+        Transient failures are raised so the message is abandoned and redelivered.
+        """
+        item_id = message_data.get('itemId')
+        
+        if message_data.get('analysisType') == 'medical':
+            item = await medical_container.read_item(item=item_id, partition_key=user_id)
+            await self.run_limited(self.process_medical_analysis, item, raise_transient=True)
+        else:
+            item = await food_container.read_item(item=item_id, partition_key=user_id)
+            await self.run_limited(self.process_food_analysis, item, raise_transient=True)
 
 # Main entry point
 async def main():
@@ -720,8 +1299,8 @@ async def main():
         await processor.start()
     except KeyboardInterrupt:
         logger.info("Received shutdown signal")
-    except Exception as e:
-        logger.error(f"Processor failed: {str(e)}")
+    except Exception:
+        logger.error("Processor failed", exc_info=True)
         raise
     finally:
         await processor.stop()
@@ -3,29 +3,59 @@
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import time
+import math
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import chain, islice
+from collections import deque
 import pandas as pd
 from PIL import Image
 import io
 import json
+import orjson
 import base64
 
 # Configuration
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
 APPLICATIONINSIGHTS_CONNECTION_STRING = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
 
-# Page configuration
-st.set_page_config(
-    page_title="AI Personal Health Companion",
-    page_icon="🏥",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+# Keep-alive connections to the API, shared by every session of this Streamlit server
+HTTP_POOL_SIZE = 16
+
+# (connect, read) timeouts in seconds, so a dead API never hangs a script thread.
+# POSTs run an analysis server side: the API gives OpenAI two 60 s attempts (about 130 s
+# with backoff) after the blob upload and Vision call, so analyses wait 180 s rather than
+# giving up on work the API then stores anyway
+API_TIMEOUT = (3, 30)
+ANALYSIS_TIMEOUT = (3, 180)
+HEALTH_CHECK_TIMEOUT = (2, 5)
 
-# Custom CSS
-st.markdown("""
-<style>
+# Uploads run on worker threads so the page keeps rendering while they are in flight
+API_WORKER_THREADS = 4
+API_POLL_INTERVAL_SECONDS = 0.05
+
+# Previews are shrunk before being sent to the browser; uploads keep full resolution
+PREVIEW_MAX_SIZE = (1024, 1024)
+PREVIEW_JPEG_QUALITY = 80
+PREVIEW_CACHE_ENTRIES = 8
+
+# Analyses kept in the session for the history page; longer OCR text is cut
+SESSION_HISTORY_MAX_ENTRIES = 200
+SESSION_HISTORY_MAX_TEXT = 10 * 1024
+
+# History fetched from the API is reused across reruns for this long
+HISTORY_CACHE_TTL_SECONDS = 60
+
+# History entries listed per page; an entry's details render only when opened
+HISTORY_PAGE_SIZE = 10
+
+# Page chrome, built once per process and emitted on every rerun: Streamlit drops
+# any element a rerun does not write again, styles included
+CUSTOM_CSS = """<style>
     .main-header {
         font-size: 2.5rem;
         color: #1f77b4;
@@ -52,31 +82,131 @@ st.markdown("""
         padding: 15px;
         margin: 10px 0;
     }
-</style>
-""", unsafe_allow_html=True)
+</style>"""
+HEADER_HTML = '<h1 class="main-header">🏥 AI Personal Health Companion</h1>'
+
+# Page configuration
+st.set_page_config(
+    page_title="AI Personal Health Companion",
+    page_icon="🏥",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
 
 # Helper functions
+@st.cache_resource
+def get_http_session():
+    """Return the pooled HTTP session used for every API call"""
+    session = requests.Session()
+    # Per-request headers are merged over these, so replies are always asked for compressed
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    # Idempotent requests are retried on connection errors and gateway failures;
+    # analysis POSTs are not, so an upload is never submitted twice
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_worker_pool():
+    """Return the thread pool that runs uploads in the background"""
+    return ThreadPoolExecutor(max_workers=API_WORKER_THREADS)
+
+def request_api(session, endpoint, method="GET", data=None, files=None, auth_token="mock-token"):
+    """Call the API and return its JSON reply, raising requests.RequestException on failure.
+    
+    The session is passed in rather than read from the Streamlit cache, so this touches
+    no Streamlit state and is safe to run on a worker thread.
+    """
+    url = f"{API_BASE_URL}{endpoint}"
+    # The session is shared across users, so the token is sent per request
+    headers = {"Authorization": f"Bearer {auth_token}"}
+    
+    if files:
+        response = session.request(method, url, headers=headers, data=data, files=files, timeout=ANALYSIS_TIMEOUT)
+    elif method == "POST":
+        headers["Content-Type"] = "application/json"
+        response = session.request(method, url, headers=headers, data=orjson.dumps(data), timeout=ANALYSIS_TIMEOUT)
+    else:
+        response = session.request(method, url, headers=headers, timeout=API_TIMEOUT)
+    
+    response.raise_for_status()
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        raise requests.exceptions.InvalidJSONError(str(e), response=response) from e
+
 def call_api(endpoint, method="GET", data=None, files=None):
     """Make API calls with error handling"""
+    return wait_for_api_call(submit_api_call(endpoint, method, data, files))
+
+def submit_api_call(endpoint, method="GET", data=None, files=None):
+    """Start an API call on the worker pool and return its future"""
+    # Cached resources are looked up here on the script thread, not in the worker
+    return get_worker_pool().submit(
+        request_api, get_http_session(), endpoint, method, data, files,
+        st.session_state.get('auth_token', 'mock-token')
+    )
+
+def wait_for_api_call(future):
+    """Wait for a submitted API call and return its reply, or None after showing the error"""
+    while not future.done():
+        time.sleep(API_POLL_INTERVAL_SECONDS)
+    
     try:
-        url = f"{API_BASE_URL}{endpoint}"
-        headers = {"Authorization": f"Bearer {st.session_state.get('auth_token', 'mock-token')}"}
-        
-        if method == "GET":
-            response = requests.get(url, headers=headers)
-        elif method == "POST":
-            if files:
-                response = requests.post(url, headers=headers, data=data, files=files)
-            else:
-                headers["Content-Type"] = "application/json"
-                response = requests.post(url, headers=headers, json=data)
-        
-        response.raise_for_status()
-        return response.json()
+        return future.result()
     except requests.exceptions.RequestException as e:
         st.error(f"API Error: {str(e)}")
         return None
 
+@st.cache_data(max_entries=PREVIEW_CACHE_ENTRIES, show_spinner=False)
+def decode_preview(raw):
+    """Decode an uploaded image once and return it shrunk to PREVIEW_MAX_SIZE as JPEG bytes"""
+    preview = Image.open(io.BytesIO(raw))
+    preview.thumbnail(PREVIEW_MAX_SIZE, Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    preview.convert("RGB").save(buffer, "JPEG", quality=PREVIEW_JPEG_QUALITY)
+    return buffer.getvalue()
+
+@st.cache_data(ttl=HISTORY_CACHE_TTL_SECONDS, show_spinner=False)
+def fetch_user_history(user_id, auth_token):
+    """Fetch a user's history from the API; cached per user and token"""
+    return request_api(get_http_session(), "/api/user-history", auth_token=auth_token)
+
+def load_user_history(user_id="demo_user"):
+    """Return the user's history, or None after showing the error"""
+    try:
+        return fetch_user_history(user_id, st.session_state.get('auth_token', 'mock-token'))
+    except requests.exceptions.RequestException as e:
+        st.error(f"API Error: {str(e)}")
+        return None
+
+def history_page_slice(entries, count, key):
+    """Show a page selector for count entries and return (offset, entries on the chosen page)"""
+    pages = max(1, math.ceil(count / HISTORY_PAGE_SIZE))
+    page = 0
+    if pages > 1:
+        page = st.number_input("Página", min_value=1, max_value=pages, value=1, key=key) - 1
+    
+    start = page * HISTORY_PAGE_SIZE
+    return start, islice(entries, start, start + HISTORY_PAGE_SIZE)
+
+def remember_analysis(analysis_type, results):
+    """Add an analysis to the bounded session history, trimming long extracted text"""
+    extracted_text = results.get('extracted_text')
+    if extracted_text and len(extracted_text) > SESSION_HISTORY_MAX_TEXT:
+        results = {**results, 'extracted_text': extracted_text[:SESSION_HISTORY_MAX_TEXT] + "…"}
+    
+    st.session_state.user_history.append({
+        "type": analysis_type,
+        "timestamp": datetime.now().isoformat(),
+        "results": results
+    })
+
 def display_food_analysis_results(results):
     """Display food analysis results in a formatted way"""
     if not results:
@@ -85,10 +215,12 @@ def display_food_analysis_results(results):
     st.markdown("### 🍽️ Análisis de Alimentos")
     
     # Food items
-    if results.get('food_items'):
+    food_items = results.get('food_items')
+    if food_items:
         st.markdown("#### Alimentos Identificados:")
-        for item in results['food_items']:
-            st.markdown(f"- **{item.get('name', 'Unknown')}**: {item.get('description', 'N/A')}")
+        st.markdown("\n".join(
+            f"- **{item.get('name', 'Unknown')}**: {item.get('description', 'N/A')}" for item in food_items
+        ))
     
     # Nutrition info
     if results.get('nutrition_info'):
@@ -108,8 +240,10 @@ def display_food_analysis_results(results):
     # Recommendations
     if results.get('recommendations'):
         st.markdown("#### Recomendaciones:")
-        for rec in results['recommendations']:
-            st.markdown(f'<div class="recommendation-card">💡 {rec}</div>', unsafe_allow_html=True)
+        st.markdown(
+            "".join(f'<div class="recommendation-card">💡 {rec}</div>' for rec in results['recommendations']),
+            unsafe_allow_html=True
+        )
 
 def display_medical_analysis_results(results):
     """Display medical document analysis results"""
@@ -119,16 +253,18 @@ def display_medical_analysis_results(results):
     st.markdown("### 📋 Análisis de Documento Médico")
     
     # Key findings
-    if results.get('key_findings'):
+    key_findings = results.get('key_findings')
+    if key_findings:
         st.markdown("#### Hallazgos Principales:")
-        for finding in results['key_findings']:
-            st.markdown(f"- {finding}")
+        st.markdown("\n".join(f"- {finding}" for finding in key_findings))
     
     # Recommendations
     if results.get('recommendations'):
         st.markdown("#### Recomendaciones Médicas:")
-        for rec in results['recommendations']:
-            st.markdown(f'<div class="recommendation-card">🏥 {rec}</div>', unsafe_allow_html=True)
+        st.markdown(
+            "".join(f'<div class="recommendation-card">🏥 {rec}</div>' for rec in results['recommendations']),
+            unsafe_allow_html=True
+        )
     
     # Extracted text (expandable)
     if results.get('extracted_text'):
@@ -137,12 +273,13 @@ def display_medical_analysis_results(results):
 
 # Main application
 def main():
-    # Header
-    st.markdown('<h1 class="main-header">🏥 AI Personal Health Companion</h1>', unsafe_allow_html=True)
+    # Custom CSS and header
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+    st.markdown(HEADER_HTML, unsafe_allow_html=True)
     
     # Initialize session state
     if 'user_history' not in st.session_state:
-        st.session_state.user_history = []
+        st.session_state.user_history = deque(maxlen=SESSION_HISTORY_MAX_ENTRIES)
     
     # Sidebar navigation
     with st.sidebar:
@@ -191,36 +328,35 @@ def food_analysis_page():
     )
     
     if uploaded_file is not None:
-        # Display uploaded image
+        # Read the upload once; the preview and the request share these bytes
+        raw = uploaded_file.getvalue()
         col1, col2 = st.columns(2)
         
+        # Start the upload before decoding the preview so the two overlap
+        with col2:
+            st.markdown("### Análisis")
+            analysis = None
+            if st.button("🔍 Analizar Comida", type="primary"):
+                files = {"file": (uploaded_file.name, raw, uploaded_file.type)}
+                data = {"notes": notes}
+                analysis = submit_api_call("/api/analyze-food", method="POST", data=data, files=files)
+        
+        # Display uploaded image
         with col1:
             st.markdown("### Vista Previa")
-            image = Image.open(uploaded_file)
-            st.image(image, caption="Imagen subida", use_column_width=True)
+            st.image(decode_preview(raw), caption="Imagen subida", use_column_width=True)
         
         with col2:
-            st.markdown("### Análisis")
-            if st.button("🔍 Analizar Comida", type="primary"):
+            if analysis is not None:
                 with st.spinner("Analizando imagen..."):
-                    # Prepare file for API call
-                    uploaded_file.seek(0)
-                    files = {"file": (uploaded_file.name, uploaded_file, uploaded_file.type)}
-                    data = {"notes": notes}
-                    
-                    # Call API
-                    results = call_api("/api/analyze-food", method="POST", data=data, files=files)
+                    results = wait_for_api_call(analysis)
                     
                     if results:
                         st.success("¡Análisis completado!")
                         display_food_analysis_results(results)
                         
                         # Save to session state
-                        st.session_state.user_history.append({
-                            "type": "food_analysis",
-                            "timestamp": datetime.now().isoformat(),
-                            "results": results
-                        })
+                        remember_analysis("food_analysis", results)
 
 def medical_analysis_page():
     """Medical document analysis page"""
@@ -243,38 +379,37 @@ def medical_analysis_page():
     st.markdown('</div>', unsafe_allow_html=True)
     
     if uploaded_file is not None:
+        # Read the upload once; the preview and the request share these bytes
+        raw = uploaded_file.getvalue()
         col1, col2 = st.columns(2)
         
+        # Start the upload before decoding the preview so the two overlap
+        with col2:
+            st.markdown("### Análisis")
+            analysis = None
+            if st.button("🔍 Analizar Documento", type="primary"):
+                files = {"file": (uploaded_file.name, raw, uploaded_file.type)}
+                data = {"document_type": doc_type.lower()}
+                analysis = submit_api_call("/api/analyze-medical-document", method="POST", data=data, files=files)
+        
         with col1:
             st.markdown("### Vista Previa")
             if uploaded_file.type == "application/pdf":
                 st.info("📄 Archivo PDF cargado correctamente")
             else:
-                image = Image.open(uploaded_file)
-                st.image(image, caption="Documento subido", use_column_width=True)
+                st.image(decode_preview(raw), caption="Documento subido", use_column_width=True)
         
         with col2:
-            st.markdown("### Análisis")
-            if st.button("🔍 Analizar Documento", type="primary"):
+            if analysis is not None:
                 with st.spinner("Procesando documento médico..."):
-                    # Prepare file for API call
-                    uploaded_file.seek(0)
-                    files = {"file": (uploaded_file.name, uploaded_file, uploaded_file.type)}
-                    data = {"document_type": doc_type.lower()}
-                    
-                    # Call API
-                    results = call_api("/api/analyze-medical-document", method="POST", data=data, files=files)
+                    results = wait_for_api_call(analysis)
                     
                     if results:
                         st.success("¡Análisis completado!")
                         display_medical_analysis_results(results)
                         
                         # Save to session state
-                        st.session_state.user_history.append({
-                            "type": "medical_analysis",
-                            "timestamp": datetime.now().isoformat(),
-                            "results": results
-                        })
+                        remember_analysis("medical_analysis", results)
 
 def recommendations_page():
     """Health recommendations page"""
@@ -304,14 +439,19 @@ def recommendations_page():
                     st.session_state.latest_recommendations = results
     
     # Display recommendations
-    if hasattr(st.session_state, 'latest_recommendations'):
+    if 'latest_recommendations' in st.session_state:
         results = st.session_state.latest_recommendations
         
         st.markdown("### 🎯 Tus Recomendaciones Personalizadas")
         
         if results.get('recommendations'):
-            for i, rec in enumerate(results['recommendations'], 1):
-                st.markdown(f'<div class="recommendation-card"><strong>{i}.</strong> {rec}</div>', unsafe_allow_html=True)
+            st.markdown(
+                "".join(
+                    f'<div class="recommendation-card"><strong>{i}.</strong> {rec}</div>'
+                    for i, rec in enumerate(results['recommendations'], 1)
+                ),
+                unsafe_allow_html=True
+            )
         
         if results.get('rationale'):
             with st.expander("Ver Explicación Detallada"):
@@ -322,12 +462,14 @@ def history_page():
     st.markdown("## 📊 Historial de Salud")
     st.markdown("Revisa tu historial completo de análisis y recomendaciones.")
     
-    # Fetch user history from API
+    # Fetch user history from API; reruns within the cache TTL reuse the last reply
     if st.button("🔄 Actualizar Historial"):
-        with st.spinner("Cargando historial..."):
-            history_data = call_api("/api/user-history")
-            if history_data:
-                st.session_state.api_history = history_data
+        fetch_user_history.clear()
+    
+    with st.spinner("Cargando historial..."):
+        history_data = load_user_history()
+        if history_data:
+            st.session_state.api_history = history_data
     
     # Display tabs for different types of history
     tab1, tab2, tab3 = st.tabs(["🍽️ Comidas", "📋 Documentos Médicos", "💡 Recomendaciones"])
@@ -336,52 +478,62 @@ def history_page():
         st.markdown("### Historial de Análisis de Comidas")
         # Display food history from session state or API
         food_history = []
-        if hasattr(st.session_state, 'api_history'):
+        if 'api_history' in st.session_state:
             food_history = st.session_state.api_history.get('food_history', [])
         
         # Also include session history
         session_food = [h for h in st.session_state.user_history if h['type'] == 'food_analysis']
         
         if food_history or session_food:
-            for entry in (food_history + session_food):
+            start, entries = history_page_slice(
+                chain(food_history, session_food), len(food_history) + len(session_food), "food_history_page"
+            )
+            for i, entry in enumerate(entries, start):
                 with st.expander(f"📸 Análisis - {entry.get('timestamp', 'Unknown time')}"):
-                    if 'results' in entry:
-                        display_food_analysis_results(entry['results'])
-                    else:
-                        st.json(entry)
+                    if st.toggle("Ver detalle", key=f"food_detail_{i}"):
+                        if 'results' in entry:
+                            display_food_analysis_results(entry['results'])
+                        else:
+                            st.json(entry)
         else:
             st.info("No hay análisis de comida en el historial.")
     
     with tab2:
         st.markdown("### Historial de Documentos Médicos")
         medical_history = []
-        if hasattr(st.session_state, 'api_history'):
+        if 'api_history' in st.session_state:
             medical_history = st.session_state.api_history.get('medical_history', [])
         
         session_medical = [h for h in st.session_state.user_history if h['type'] == 'medical_analysis']
         
         if medical_history or session_medical:
-            for entry in (medical_history + session_medical):
+            start, entries = history_page_slice(
+                chain(medical_history, session_medical), len(medical_history) + len(session_medical), "medical_history_page"
+            )
+            for i, entry in enumerate(entries, start):
                 with st.expander(f"📋 Documento - {entry.get('timestamp', 'Unknown time')}"):
-                    if 'results' in entry:
-                        display_medical_analysis_results(entry['results'])
-                    else:
-                        st.json(entry)
+                    if st.toggle("Ver detalle", key=f"medical_detail_{i}"):
+                        if 'results' in entry:
+                            display_medical_analysis_results(entry['results'])
+                        else:
+                            st.json(entry)
         else:
             st.info("No hay documentos médicos en el historial.")
     
     with tab3:
         st.markdown("### Historial de Recomendaciones")
         recommendations_history = []
-        if hasattr(st.session_state, 'api_history'):
+        if 'api_history' in st.session_state:
             recommendations_history = st.session_state.api_history.get('recommendations_history', [])
         
         if recommendations_history:
-            for entry in recommendations_history:
+            _, entries = history_page_slice(
+                recommendations_history, len(recommendations_history), "recommendations_history_page"
+            )
+            for entry in entries:
                 with st.expander(f"💡 Recomendaciones - {entry.get('timestamp', 'Unknown time')}"):
                     if entry.get('recommendations'):
-                        for rec in entry['recommendations']:
-                            st.markdown(f"- {rec}")
+                        st.markdown("\n".join(f"- {rec}" for rec in entry['recommendations']))
                     if entry.get('rationale'):
                         st.markdown(f"**Explicación:** {entry['rationale']}")
         else:
@@ -397,11 +549,13 @@ def settings_page():
     
     if st.button("Probar Conexión"):
         try:
-            response = requests.get(f"{api_url}/health")
+            response = get_http_session().get(f"{api_url}/health", timeout=HEALTH_CHECK_TIMEOUT)
             if response.status_code == 200:
                 st.success("✅ Conexión exitosa con la API")
             else:
                 st.error("❌ Error de conexión con la API")
+        except requests.exceptions.Timeout:
+            st.error("❌ La API no respondió a tiempo")
         except Exception as e:
             st.error(f"❌ Error: {str(e)}")
     